@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import re
+import ozpickle
+import ozfgen
+import ozify
+import opcodes
+import disasm
+import ozx
+from ozpickle import Cell
+from oznodes import Node, Cons, Tuple, Record, Builtin, Reg, PatMatCapture, WILDCARD
+
+def make_graph_nodes(count):
+    # the last node is the root; every tuple links to its predecessor and to
+    # a random node anywhere in the graph, so there are long paths and cycles.
+    rng = random.Random(count)
+    nodes = ['leaf{}'.format(i) for i in range(16)]
+    for i in range(16, count):
+        children = [Cell(i - 1), Cell(rng.randrange(count))]
+        nodes.append(Tuple(Cell(i % 16), children))
+    return nodes
+
+def make_chain_nodes(length):
+    # node 0 is the list head, each cons cell points to the next one.
+    nodes = []
+    for i in range(length):
+        nodes.append(Cons(Cell(length + 1 + i), Cell(i + 1)))
+    nodes.append('nil')
+    nodes.extend(range(length))
+    return nodes
+
+def bench_resolve(nodes, root_index):
+    start = time.perf_counter()
+    ozpickle.resolve(Cell(root_index), nodes, set())
+    return time.perf_counter() - start
+
+# The previous ozify, dispatching with singledispatch and a dict of lambdas,
+# kept as the baseline of the ozify benchmark.
+@functools.singledispatch
+def legacy_ozify(r, **kwargs):
+    return str(r)
+
+@legacy_ozify.register(bool)
+def _(r, **kwargs):
+    return 'true' if r else 'false'
+
+@legacy_ozify.register(int)
+@legacy_ozify.register(float)
+def _(r, **kwargs):
+    return str(r).replace('-', '~')
+
+@legacy_ozify.register(str)
+def _(r, **kwargs):
+    if not re.match('^[a-z][a-z0-9A-Z_]*$', r) or r in ozify.KEYWORDS:
+        return "'" + re.sub(r"(['\\])", r"\\\1", r) + "'"
+    else:
+        return r
+
+@legacy_ozify.register(Node)
+def _(r, **kwargs):
+    if r.ref_fields:
+        visited = kwargs.get('visited', set())
+        if id(r) in visited:
+            return '...'
+        visited.add(id(r))
+        kwargs['visited'] = visited
+
+    def record(label, items):
+        entries = ['{}:{}'.format(legacy_ozify(k, **kwargs), legacy_ozify(v, **kwargs))
+                   for k, v in items]
+        return '{}({})'.format(label, ' '.join(entries))
+
+    return {
+        'cons': lambda: '{}|{}'.format(legacy_ozify(r.head, **kwargs), legacy_ozify(r.tail, **kwargs)),
+        'tuple': lambda: '{}({})'.format(legacy_ozify(r.label, **kwargs),
+                                         ' '.join(legacy_ozify(c, **kwargs) for c in r.contents)),
+        'record': lambda: record(r.label, r.items),
+        'builtin': lambda: '{}.{}'.format(r.module, legacy_ozify(r.name, **kwargs)),
+        'patmatwildcard': lambda: '_',
+        'patmatcapture': lambda: '?X{}'.format(r.index),
+        'reg': lambda: '{}{}'.format(r.regclass, r.num),
+    }[r.tag]()
+
+def make_constants(count):
+    # what the operands of a typical codearea look like.
+    rng = random.Random(count)
+    atoms = ['nil', 'true', 'value', 'Show', 'end', 'get', 'put', 'x1']
+    values = []
+    for i in range(count):
+        kind = i % 6
+        if kind == 0:
+            values.append(rng.choice(atoms))
+        elif kind == 1:
+            values.append(Builtin('Value', rng.choice(['.', '==', 'catAccess', '+'])))
+        elif kind == 2:
+            values.append(Reg(rng.choice('XYG'), rng.randrange(16)))
+        elif kind == 3:
+            values.append(rng.randrange(-1000, 1000))
+        elif kind == 4:
+            values.append(Tuple('pair', [PatMatCapture(rng.randrange(8)), WILDCARD]))
+        else:
+            values.append(Record('r', [('a', Cons(1, 'nil')), ('b', rng.choice(atoms))]))
+    return values
+
+def bench_ozify(render, values):
+    start = time.perf_counter()
+    for value in values:
+        render(value)
+    return time.perf_counter() - start
+
+@functools.lru_cache(maxsize=None)
+def make_ozf(codeareas, same_body=0.0):
+    return ozpickle.dumps(ozfgen.generate(codeareas, same_body=same_body))
+
+# the fraction of codeareas copying an earlier body in the --dedupe benchmarks.
+SAME_BODY = 0.4
+
+def load_codeareas(buf):
+    node_table = ozpickle.loads(buf, lazy=True)
+    return [node_table.resolve(index) for index in node_table.indexes('codearea')]
+
+def bench_unpickle(buf):
+    start = time.perf_counter()
+    ozpickle.BufferUnpickler(buf).read_nodes()
+    return time.perf_counter() - start
+
+def bench_file_resolve(buf):
+    (nodes, result_index) = ozpickle.BufferUnpickler(buf).read_nodes()
+    start = time.perf_counter()
+    ozpickle.resolve(nodes[result_index], nodes, set())
+    return time.perf_counter() - start
+
+def bench_decode(codeareas):
+    start = time.perf_counter()
+    for ca in codeareas:
+        list(opcodes.InstructionStream(ca.code, ca.ks))
+    return time.perf_counter() - start
+
+def bench_file_load(buf):
+    # what an *.ozx file replaces: unpickling, resolving and decoding.
+    start = time.perf_counter()
+    for ca in load_codeareas(buf):
+        stream = opcodes.InstructionStream(ca.code, ca.ks)
+        (stream.pcs, stream.opcodes, ca.name, ca.uuid, ca.ks)
+    return time.perf_counter() - start
+
+@functools.lru_cache(maxsize=None)
+def make_ozx(codeareas):
+    out = io.BytesIO()
+    ozx.export(load_codeareas(make_ozf(codeareas)), out)
+    return out.getvalue()
+
+def bench_ozx_load(buf):
+    start = time.perf_counter()
+    for proc in ozx.loads(buf):
+        (proc.pcs, proc.opcodes, proc.name, proc.uuid, proc.constants)
+    return time.perf_counter() - start
+
+def bench_render(codeareas):
+    start = time.perf_counter()
+    for ca in codeareas:
+        disasm.render_codearea(ca)
+    return time.perf_counter() - start
+
+def bench_render_deduped(codeareas):
+    start = time.perf_counter()
+    (firsts, unique) = disasm.dedupe_codeareas(codeareas, {})
+    for text in disasm.with_references(firsts, map(disasm.render_codearea, unique)):
+        pass
+    return time.perf_counter() - start
+
+BENCHMARKS = {
+    'ozify': lambda size: bench_ozify(ozify.ozify, make_constants(size)),
+    'ozify-legacy': lambda size: bench_ozify(legacy_ozify, make_constants(size)),
+    'resolve-graph': lambda size: bench_resolve(make_graph_nodes(size), size - 1),
+    'resolve-chain': lambda size: bench_resolve(make_chain_nodes(size), 0),
+    # the file benchmarks run on a synthetic file of `size` codeareas.
+    'file-unpickle': lambda size: bench_unpickle(make_ozf(size)),
+    'file-resolve': lambda size: bench_file_resolve(make_ozf(size)),
+    'file-decode': lambda size: bench_decode(load_codeareas(make_ozf(size))),
+    'file-render': lambda size: bench_render(load_codeareas(make_ozf(size))),
+    'file-render-same-body':
+        lambda size: bench_render(load_codeareas(make_ozf(size, SAME_BODY))),
+    'file-render-dedupe':
+        lambda size: bench_render_deduped(load_codeareas(make_ozf(size, SAME_BODY))),
+    'file-load': lambda size: bench_file_load(make_ozf(size)),
+    'ozx-load': lambda size: bench_ozx_load(make_ozx(size)),
+}
+
+DEFAULT_SIZES = {
+    'ozify': 10**5,
+    'ozify-legacy': 10**5,
+    'resolve-graph': 10**6,
+    'resolve-chain': 10**5,
+    'file-unpickle': 5000,
+    'file-resolve': 5000,
+    'file-decode': 2000,
+    'file-render': 2000,
+    'file-render-same-body': 2000,
+    'file-render-dedupe': 2000,
+    'file-load': 2000,
+    'ozx-load': 2000,
+}
+
+# milliseconds of imports allowed for `disasm.py --help`, see --import-budget.
+IMPORT_BUDGET = 50
+
+def top_level_imports(args, env):
+    # {module: cumulative microseconds} of `python -X importtime args`.
+    err = subprocess.run([sys.executable, '-X', 'importtime'] + args, env=env,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True).stderr
+    imports = {}
+    for line in err.decode().splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S.*)$', line)
+        if match:
+            imports[match.group(2)] = int(match.group(1))
+    return imports
+
+def import_time(args, runs=5):
+    # The best time in ms spent importing the modules which `python args`
+    # needs beyond the interpreter startup, with the bytecode cached.
+    with tempfile.TemporaryDirectory() as pycache:
+        env = dict(os.environ, PYTHONPYCACHEPREFIX=pycache)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        subprocess.run([sys.executable] + args, env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        startup = top_level_imports(['-c', 'pass'], env)
+        times = []
+        for _ in range(runs):
+            imports = top_level_imports(args, env)
+            times.append(sum(t for name, t in imports.items() if name not in startup) / 1000)
+    return min(times)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run micro-benchmarks')
+    parser.add_argument('-n', '--size', type=int, help='Override the problem size')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Keep the best of this many runs (default: %(default)s)')
+    parser.add_argument('-s', '--save', type=argparse.FileType('w'), metavar='FILE',
+                        help='Save the results as JSON')
+    parser.add_argument('-b', '--baseline', type=argparse.FileType('r'), metavar='FILE',
+                        help='Compare with results saved by an earlier run')
+    parser.add_argument('--import-budget', type=float, nargs='?', const=IMPORT_BUDGET, metavar='MS',
+                        help='Instead, fail if the imports of `disasm.py --help` take longer '
+                             '(default: %(const)s ms)')
+    parser.add_argument('names', nargs='*', help='Benchmarks to run (default: all)')
+    ns = parser.parse_args(args)
+
+    if ns.import_budget is not None:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'disasm.py')
+        ms = import_time([script, '--help'])
+        print('disasm.py --help imports: {:.1f} ms (budget {:.0f} ms)'.format(ms, ns.import_budget))
+        if ms > ns.import_budget:
+            sys.exit(1)
+        return
+
+    baseline = json.load(ns.baseline)['results'] if ns.baseline else {}
+    results = {}
+    for name in ns.names or sorted(BENCHMARKS):
+        size = ns.size or DEFAULT_SIZES[name]
+        seconds = min(BENCHMARKS[name](size) for _ in range(ns.repeat))
+        rate = size / seconds
+        results[name] = {'size': size, 'seconds': seconds, 'rate': rate}
+        line = '{:20} {:>10} items {:10.3f} s {:14.0f} items/s'.format(name, size, seconds, rate)
+        if name in baseline:
+            line += '  {:6.2f}x baseline'.format(rate / baseline[name]['rate'])
+        print(line)
+
+    if ns.save is not None:
+        json.dump({'python': platform.python_version(), 'results': results}, ns.save, indent=2)
+        ns.save.write('\n')
+
+if __name__ == '__main__':
+    main()
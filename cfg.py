@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Basic blocks and control-flow graph of a codearea, built in one pass over
+# its InstructionStream.
+
+import array
+import bisect
+import opcodes
+
+# instructions after which execution never continues at the next one.
+NO_FALLTHROUGH = frozenset([0x40, 0x41, 0x42, 0x43, 0x44, 0x45, 0x46] +
+                           list(range(0x2b, 0x2f)) + list(range(0x34, 0x38)))
+
+class BasicBlock:
+    __slots__ = ('index', 'start', 'end', 'first', 'last', 'succs', 'preds')
+
+    def __init__(self, index, start, first):
+        self.index = index
+        self.start = start
+        self.end = start
+        self.first = first
+        self.last = first
+        self.succs = []
+        self.preds = []
+
+    def __repr__(self):
+        return 'BasicBlock({}, {}..{}, succs={})'.format(self.index, self.start, self.end,
+                                                          [b.index for b in self.succs])
+
+    def instructions(self):
+        # indexes into the InstructionStream.
+        return range(self.first, self.last + 1)
+
+
+class ControlFlowGraph:
+    def __init__(self, stream):
+        self.stream = stream
+        (pcs, ops, lengths) = (stream.pcs, stream.opcodes, stream.lengths)
+        size = len(stream.words)
+
+        # leaders are the entry, the jump targets and what follows a jump.
+        successors = {}
+        self.jump_targets = set()
+        is_leader = bytearray(size + 1)
+        is_leader[0] = 1
+        for i, (pc, opcode) in enumerate(zip(pcs, ops)):
+            info = opcodes.OPCODES[opcode] if opcode < len(opcodes.OPCODES) else None
+            if info is None or (info.targets is None and opcode not in NO_FALLTHROUGH):
+                continue
+            if info.targets is not None:
+                targets = [t for t in info.targets(stream.words, pc, stream.ks) if 0 <= t < size]
+                self.jump_targets.update(targets)
+                for target in targets:
+                    is_leader[target] = 1
+            else:
+                targets = []
+            next_pc = pc + lengths[i]
+            if opcode not in NO_FALLTHROUGH and next_pc < size:
+                targets.append(next_pc)
+            successors[i] = targets
+            is_leader[min(next_pc, size)] = 1
+
+        self.blocks = []
+        self.starts = array.array('I')
+        block = None
+        for i, pc in enumerate(pcs):
+            if is_leader[pc] or block is None:
+                block = BasicBlock(len(self.blocks), pc, i)
+                self.blocks.append(block)
+                self.starts.append(pc)
+            block.last = i
+            block.end = pc + lengths[i]
+
+        for block in self.blocks:
+            if block.last in successors:
+                targets = successors[block.last]
+            elif block.index + 1 < len(self.blocks):
+                targets = [block.end]
+            else:
+                targets = []
+            for target in targets:
+                succ = self.block_starting_at(target)
+                if succ is not None and succ not in block.succs:
+                    block.succs.append(succ)
+                    succ.preds.append(block)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def block_at(self, pc):
+        # the block containing the instruction at or covering `pc`, or None.
+        i = bisect.bisect_right(self.starts, pc) - 1
+        if i < 0 or pc >= self.blocks[i].end:
+            return None
+        return self.blocks[i]
+
+    def block_starting_at(self, pc):
+        block = self.block_at(pc)
+        return block if block is not None and block.start == pc else None
+
+    def to_dot(self, name='cfg'):
+        lines = ['digraph "{}" {{'.format(name.replace('"', '\\"')), '  node [shape=box];']
+        for block in self.blocks:
+            lines.append('  b{} [label="{}..{}"];'.format(block.start, block.start, block.end))
+            for succ in block.succs:
+                lines.append('  b{} -> b{};'.format(block.start, succ.start))
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        return [{
+            'start': block.start,
+            'end': block.end,
+            'succs': [succ.start for succ in block.succs],
+            'preds': [pred.start for pred in block.preds],
+        } for block in self.blocks]
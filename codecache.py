@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# Persistent cache of disassembled codeareas, stored in a SQLite database.
+#
+# Entries are keyed by the codearea UUID and a digest of its code and of the
+# rendered constants, so a rebuilt codearea reusing its UUID is not mistaken
+# for the old one. The least recently used entries are evicted once the total
+# size of the cached data exceeds `max_size` bytes.
+
+import array
+import collections
+import os
+import sys
+import time
+import oznodes
+
+# bump when the rendering changes, to invalidate older entries.
+CACHE_VERSION = b'1'
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# new entries written per transaction.
+PUT_BATCH = 256
+
+def default_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'ozf2-disasm', 'codeareas.sqlite')
+
+def flatten_constants(ks):
+    # A preorder serialization of the constants graph, enough to tell apart
+    # any two which render differently. Nested procedures are only rendered
+    # by name, so they are not followed.
+    parts = []
+    seen = {}
+    stack = [ks]
+    while stack:
+        v = stack.pop()
+        t = type(v)
+        if t is list or isinstance(v, oznodes.Node):
+            if id(v) in seen:
+                parts.append('@{}'.format(seen[id(v)]))
+                continue
+            seen[id(v)] = len(seen)
+            if t is list:
+                parts.append('[{}'.format(len(v)))
+                stack.extend(reversed(v))
+            elif t is oznodes.CodeArea:
+                parts.append('C{!r}/{}'.format(v.name, v.arity))
+            elif t is oznodes.Abstraction:
+                parts.append('A')
+                stack.append(v.codearea)
+            else:
+                parts.append(v.tag)
+                stack.extend(getattr(v, f) for f in reversed(v.fields))
+        elif t is tuple:
+            parts.append('({}'.format(len(v)))
+            stack.extend(reversed(v))
+        else:
+            parts.append('{}:{!r}'.format(t.__name__, v))
+    return '\0'.join(parts)
+
+def codearea_digest(ca, variant=b''):
+    # hashlib and sqlite3 are imported on first use, they are slow to load
+    # and most runs have no cache.
+    import hashlib
+    h = hashlib.sha256(CACHE_VERSION + variant)
+    h.update(len(ca.code).to_bytes(4, 'big'))
+    h.update(ca.code)
+    h.update(flatten_constants(ca.ks).encode('utf-8', 'surrogatepass'))
+    return h.digest()
+
+def codearea_key(ca, variant=b''):
+    # `variant` tells apart the renderings of the same codearea with different options.
+    return (ca.uuid or b'', codearea_digest(ca, variant))
+
+
+class CodeCache:
+    # The database is in WAL mode and only written in short transactions: the
+    # new entries every PUT_BATCH puts, the last use of the entries read on
+    # flush(), so concurrent runs sharing it do not wait for each other. If it
+    # becomes unusable (e.g. locked for too long) the run goes on without it.
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE):
+        import sqlite3
+        path = path or default_path()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_size = max_size
+        self.error = sqlite3.Error
+        self.db = sqlite3.connect(path, timeout=30)
+        try:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            with self.db:
+                self.db.execute('''
+                    CREATE TABLE IF NOT EXISTS codeareas (
+                        uuid BLOB NOT NULL,
+                        digest BLOB NOT NULL,
+                        text TEXT NOT NULL,
+                        pcs BLOB NOT NULL,
+                        opcodes BLOB NOT NULL,
+                        size INTEGER NOT NULL,
+                        last_used REAL NOT NULL,
+                        PRIMARY KEY (uuid, digest)
+                    )''')
+                self.db.execute('CREATE INDEX IF NOT EXISTS codeareas_last_used '
+                                'ON codeareas (last_used)')
+        except sqlite3.Error:
+            self.db.close()
+            raise
+        self.pending = []
+        self.touched = set()
+        self.hits = 0
+        self.misses = 0
+
+    def failed(self, error):
+        print('codecache: {}, continuing without the cache'.format(error), file=sys.stderr)
+        self.db.close()
+        self.db = None
+
+    def lookup(self, key):
+        # the (text, pcs, opcodes) row of the given codearea_key(), or None.
+        row = None
+        if self.db is not None:
+            try:
+                row = self.db.execute('SELECT text, pcs, opcodes FROM codeareas '
+                                      'WHERE uuid = ? AND digest = ?', key).fetchone()
+            except self.error as e:
+                self.failed(e)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touched.add(key)
+        return row
+
+    def get(self, key):
+        # the rendered text of the codearea, or None.
+        row = self.lookup(key)
+        return row[0] if row is not None else None
+
+    def get_instructions(self, key):
+        # the (pcs, opcodes) arrays of the codearea, or None.
+        row = self.lookup(key)
+        if row is None:
+            return None
+        (pcs, opcodes) = (array.array('I'), array.array('H'))
+        pcs.frombytes(row[1])
+        opcodes.frombytes(row[2])
+        return (pcs, opcodes)
+
+    def put(self, key, text, pcs, opcodes):
+        if self.db is None:
+            return
+        pcs = pcs.tobytes()
+        opcodes = opcodes.tobytes()
+        size = len(text) + len(pcs) + len(opcodes)
+        self.pending.append(key + (text, pcs, opcodes, size, time.time()))
+        if len(self.pending) >= PUT_BATCH:
+            self.flush()
+
+    def flush(self):
+        # writes the new entries and the last use of those read, and commits.
+        if self.db is None:
+            return
+        now = time.time()
+        try:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO codeareas VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    self.pending)
+                self.db.executemany('UPDATE codeareas SET last_used = ? WHERE uuid = ? AND digest = ?',
+                                    [(now,) + key for key in self.touched])
+        except self.error as e:
+            self.failed(e)
+        self.pending = []
+        self.touched = set()
+
+    def evict(self):
+        (total,) = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM codeareas').fetchone()
+        if total <= self.max_size:
+            return
+        rows = self.db.execute('SELECT rowid, size FROM codeareas ORDER BY last_used')
+        stale = []
+        for rowid, size in rows:
+            if total <= self.max_size:
+                break
+            stale.append((rowid,))
+            total -= size
+        with self.db:
+            self.db.executemany('DELETE FROM codeareas WHERE rowid = ?', stale)
+
+    def close(self):
+        self.flush()
+        if self.db is None:
+            return
+        try:
+            self.evict()
+        except self.error as e:
+            self.failed(e)
+            return
+        self.db.close()
+        self.db = None
+
+
+def open_cache(path=None, max_size=DEFAULT_MAX_SIZE):
+    # a CodeCache, or None when the database cannot be opened.
+    import sqlite3
+    try:
+        return CodeCache(path, max_size)
+    except sqlite3.Error as e:
+        print('codecache: {}, continuing without the cache'.format(e), file=sys.stderr)
+        return None
+
+
+class MemoryCache:
+    # In-process cache of rendered codeareas, shared by all the files of a
+    # run, optionally in front of a CodeCache. Keeps at most `max_size`
+    # characters of text, dropping the least recently used first.
+    def __init__(self, backing=None, max_size=64 * 1024 * 1024):
+        self.backing = backing
+        self.max_size = max_size
+        self.size = 0
+        self.texts = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        text = self.texts.get(key)
+        if text is not None:
+            self.hits += 1
+            self.texts.move_to_end(key)
+            return text
+        self.misses += 1
+        if self.backing is not None:
+            text = self.backing.get(key)
+            if text is not None:
+                self.remember(key, text)
+        return text
+
+    def remember(self, key, text):
+        old = self.texts.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.texts[key] = text
+        self.size += len(text)
+        while self.size > self.max_size:
+            self.size -= len(self.texts.popitem(last=False)[1])
+
+    def put(self, key, text, pcs, opcodes):
+        self.remember(key, text)
+        if self.backing is not None:
+            self.backing.put(key, text, pcs, opcodes)
+
+    def flush(self):
+        if self.backing is not None:
+            self.backing.flush()
+
+    def close(self):
+        if self.backing is not None:
+            self.backing.close()
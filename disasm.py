@@ -1,80 +1,700 @@
 #!/usr/bin/env python3
 
 import ozpickle
+import oznodes
 import opcodes
+import codecache
+import perfstats
+from perfstats import timed
 import sys
 import argparse
-import collections
-try:
-    from functools import singledispatch
-except ImportError:
-    from singledispatch import singledispatch
-
-CodeAreaDumpState = collections.namedtuple('CodeAreaDumpState',
-                                           ['visited', 'filter'])
-
-def visit_object(obj, state):
-    if id(obj) in state.visited:
-        return True
+import contextlib
+import io
+import os
+import glob
+import fnmatch
+import re
+import functools
+# opstats (NumPy), cfg, json, pickle, difflib, cProfile, tracemalloc and
+# concurrent.futures are only imported by the modes using them, to keep
+# the startup short.
+
+def find_codeareas(root, code_ids=None):
+    # The codeareas reachable from `root`, in depth-first order, following
+    # only the code_fields of the nodes and, when given, only the nodes whose
+    # id is in `code_ids` (see ozpickle.code_flags). Lists and the (feature,
+    # value) pairs of records are always followed.
+    found = []
+    visited = set()
+    pending = [[root]]
+    while pending:
+        value = pending.pop()
+        t = type(value)
+        if t is list or t is tuple:
+            children = value
+        elif id(value) in visited:
+            continue
+        else:
+            visited.add(id(value))
+            if t is oznodes.CodeArea:
+                found.append(value)
+            children = [getattr(value, field) for field in t.code_fields]
+        for child in reversed(children):
+            t = type(child)
+            if t is list or t is tuple:
+                pending.append(child)
+            elif code_ids is None:
+                if isinstance(child, oznodes.Node) and t.code_fields:
+                    pending.append(child)
+            elif id(child) in code_ids:
+                pending.append(child)
+    return found
+
+def disassemble_filtered(node_table, ns):
+    # only the matching codeareas (and what they reference) are parsed.
+    infos = select_codeareas(node_table.codearea_index(), ns.filter)
+    with timed(ns.stats, 'resolve'):
+        codeareas = [node_table.resolve(info.index) for info in infos]
+    print_codeareas(codeareas, ns)
+
+def name_matcher(pattern):
+    if pattern.startswith('re:'):
+        return re.compile(pattern[3:]).search
+    elif glob.has_magic(pattern):
+        return re.compile(fnmatch.translate(pattern)).match
     else:
-        state.visited.add(id(obj))
-        return False
+        return pattern.__eq__
+
+def select_codeareas(index, patterns):
+    # The codeareas whose name matches any of the patterns, in file order.
+    # Plain names are looked up directly, the others are matched against
+    # every distinct name.
+    if not patterns:
+        return list(index)
+    selected = set()
+    matchers = []
+    for pattern in patterns:
+        if pattern.startswith('re:') or glob.has_magic(pattern):
+            matchers.append(name_matcher(pattern))
+        else:
+            selected.update(info.index for info in index.by_name.get(pattern, ()))
+    if matchers:
+        for name, infos in index.by_name.items():
+            if any(matcher(name) for matcher in matchers):
+                selected.update(info.index for info in infos)
+    return [info for info in index if info.index in selected]
+
+def list_codeareas(node_table, ns):
+    for info in select_codeareas(node_table.codearea_index(), ns.filter):
+        print('{}/{}\txcount={}\tsize={}'.format(info.name or '$', info.arity, info.xcount, info.size))
 
+def match_codeareas(old_infos, new_infos):
+    # (pairs, removed, added): the codeareas of two builds matched by UUID,
+    # the others then by name and arity, in file order.
+    pairs = []
+    unmatched = []
+    by_uuid = {}
+    for info in new_infos:
+        if info.uuid != ozpickle.NIL_UUID:
+            by_uuid.setdefault(info.uuid, []).append(info)
+    for info in old_infos:
+        candidates = by_uuid.get(info.uuid)
+        if candidates:
+            pairs.append((info, candidates.pop(0)))
+        else:
+            unmatched.append(info)
+    matched = set(new.index for _, new in pairs)
+    by_name = {}
+    for info in new_infos:
+        if info.index not in matched:
+            by_name.setdefault((info.name, info.arity), []).append(info)
+    removed = []
+    for info in unmatched:
+        candidates = by_name.get((info.name, info.arity))
+        if candidates:
+            pairs.append((info, candidates.pop(0)))
+        else:
+            removed.append(info)
+    matched = set(new.index for _, new in pairs)
+    added = [info for info in new_infos if info.index not in matched]
+    pairs.sort(key=lambda pair: pair[1].index)
+    return (pairs, removed, added)
 
-def disassemble(unpickled_obj, ns):
-    state = CodeAreaDumpState(set(), ns.filter)
-    dump_codearea(unpickled_obj, state)
+def codearea_lines(ca):
+    # (pc or None, text) of the signature and of each instruction.
+    lines = [(None, 'asm proc {{{} {}}} xcount={}'.format(
+        ca.name or '$', ' '.join(map('X{}'.format, range(ca.arity))), ca.xcount))]
+    lines += [(pc, str(opcode)) for pc, opcode in opcodes.InstructionStream(ca.code, ca.ks)]
+    return lines
 
-@singledispatch
-def dump_codearea(k, state):
-    pass
+def print_codearea_diff(old, new, context=3):
+    # The instructions which differ, without their pcs so that moved code
+    # is not reported, in hunks of a unified diff.
+    import difflib
+    (a, b) = (codearea_lines(old), codearea_lines(new))
+    matcher = difflib.SequenceMatcher(None, [text for _, text in a], [text for _, text in b],
+                                      autojunk=False)
+    hunks = list(matcher.get_grouped_opcodes(context))
+    name = '{}/{}'.format(new.name or '$', new.arity)
+    if old.name != new.name or old.arity != new.arity:
+        name = '{}/{} -> {}'.format(old.name or '$', old.arity, name)
+    print('%%% changed {}{}'.format(name, '' if hunks else ' (constants only)'))
+    for hunk in hunks:
+        print('@@ -{} +{} @@'.format(a[hunk[0][1]][0] or 0, b[hunk[0][3]][0] or 0))
+        for tag, i1, i2, j1, j2 in hunk:
+            if tag == 'equal':
+                lines = [(' ', line) for line in a[i1:i2]]
+            else:
+                lines = [('-', line) for line in a[i1:i2]] + [('+', line) for line in b[j1:j2]]
+            for mark, (pc, text) in lines:
+                prefix = mark + (pc_prefix(pc)[1:] if pc is not None else ' ')
+                print(prefix + text.replace('\n', '\n' + prefix))
+    print()
 
-@dump_codearea.register(list)
-def _(lst, state):
-    if visit_object(lst, state):
+def diff_files(old_path, new_path, ns):
+    # Only the matched codeareas whose code or constants differ are decoded.
+    tables = []
+    for path in (old_path, new_path):
+        with open_input(path) as f:
+            tables.append(load_cached(load_table, f, ns))
+    (old_infos, new_infos) = (select_codeareas(t.codearea_index(), ns.filter) for t in tables)
+    (pairs, removed, added) = match_codeareas(old_infos, new_infos)
+    changed = 0
+    for old_info, new_info in pairs:
+        with timed(ns.stats, 'resolve'):
+            (old, new) = (t.resolve(info.index) for t, info in zip(tables, (old_info, new_info)))
+            same = (old_info[2:] == new_info[2:] and
+                    codecache.codearea_digest(old) == codecache.codearea_digest(new))
+        if not same:
+            with timed(ns.stats, 'render'):
+                print_codearea_diff(old, new)
+            changed += 1
+    for kind, infos in (('added', added), ('removed', removed)):
+        for info in infos:
+            print('%%% {} {}/{}'.format(kind, info.name or '$', info.arity))
+    print('%%% {} added, {} removed, {} changed, {} unchanged'.format(
+        len(added), len(removed), changed, len(pairs) - changed))
+    if ns.stats is not None:
+        ns.stats.codeareas += 2 * changed
+        for t in tables:
+            ns.stats.count_deduplicated(t.unpickler)
+
+def print_codeareas(codeareas, ns):
+    if ns.cfg is not None:
+        for ca in codeareas:
+            print_cfg(ca, ns.cfg)
         return
+    stats = ns.stats
+    if stats is not None:
+        stats.codeareas += len(codeareas)
+    if ns.bodies is not None:
+        with timed(stats, 'decode'):
+            (firsts, codeareas) = dedupe_codeareas(codeareas, ns.bodies, stats)
+    if ns.executor is not None and len(codeareas) > 1:
+        texts = render_parallel(codeareas, ns.executor, ns.jobs, ns.cache, ns.labels)
+        if stats is not None:
+            # the workers are not measured, only the time waiting for them.
+            texts = timed_iter(texts, stats, 'render')
+    else:
+        texts = (render_cached(ca, ns.cache, ns.labels, stats) for ca in codeareas)
+    if ns.bodies is not None:
+        texts = with_references(firsts, texts)
+    for text in texts:
+        with timed(stats, 'write'):
+            sys.stdout.write(text)
+        if stats is not None:
+            stats.bytes_written += len(text)
+
+def dedupe_codeareas(codeareas, bodies, stats=None):
+    # (firsts, unique): the first codearea with the same code and constants
+    # as each one, and the codeareas which are the first with their body.
+    # `bodies` maps the code to the first codearea with it, across calls;
+    # the constants are only flattened (see codecache) once the code repeats.
+    firsts = []
+    unique = []
+    for ca in codeareas:
+        code = bytes(ca.code)
+        same_code = bodies.get(code)
+        if same_code is None:
+            bodies[code] = first = ca
+        else:
+            if type(same_code) is not dict:
+                same_code = bodies[code] = {codecache.flatten_constants(same_code.ks): same_code}
+            first = same_code.setdefault(codecache.flatten_constants(ca.ks), ca)
+        if first is ca:
+            unique.append(ca)
+        elif stats is not None:
+            stats.same_body += 1
+            stats.same_body_bytes += len(ca.code)
+        firsts.append((ca, first))
+    return (firsts, unique)
+
+def with_references(firsts, texts):
+    # the texts of the unique codeareas, with the others referring to them.
+    for ca, first in firsts:
+        if first is ca:
+            yield next(texts)
+        else:
+            yield '{}  /* same body as {}/{} */\nend\n\n'.format(
+                codearea_header(ca), first.name or '$', first.arity)
+
+def timed_iter(iterable, stats, name):
+    iterator = iter(iterable)
+    while True:
+        with stats.phase(name):
+            item = next(iterator, None)
+        if item is None:
+            return
+        yield item
+
+def print_cfg(ca, fmt):
+    import cfg
+    import json
+    graph = cfg.ControlFlowGraph(opcodes.InstructionStream(ca.code, ca.ks))
+    name = '{}/{}'.format(ca.name or '$', ca.arity)
+    if fmt == 'dot':
+        sys.stdout.write(graph.to_dot(name))
+    else:
+        print(json.dumps({'name': name, 'blocks': graph.to_json()}))
+
+def cache_key(ca, labels):
+    return codecache.codearea_key(ca, b'labels' if labels else b'')
+
+def render_cached(ca, cache, labels=False, stats=None):
+    if cache is None:
+        return render_codearea(ca, labels=labels, stats=stats)
+    key = cache_key(ca, labels)
+    text = cache.get(key)
+    if text is None:
+        with timed(stats, 'decode'):
+            stream = opcodes.InstructionStream(ca.code, ca.ks)
+        text = render_codearea(ca, stream, labels, stats)
+        cache.put(key, text, stream.pcs, stream.opcodes)
+    return text
+
+@functools.lru_cache(maxsize=None)
+def detaching_pickler():
+    # built on first use, pickle is only needed with -j.
+    import pickle
+
+    class DetachingPickler(pickle.Pickler):
+        # Pickles the constants of a codearea without the rest of the graph.
+        # Nested procedures are only rendered by their name and arity, so they
+        # are replaced by stubs without code, constants or globals.
+        def reducer_override(self, obj):
+            if type(obj) is oznodes.CodeArea:
+                return (oznodes.CodeArea, (obj.uuid, b'', obj.arity, obj.xcount, obj.name, None, []))
+            elif type(obj) is oznodes.Abstraction:
+                return (oznodes.Abstraction, (obj.uuid, obj.codearea, []))
+            return NotImplemented
+
+    return DetachingPickler
+
+def detach_codearea(ca, labels=False):
+    import pickle
+    out = io.BytesIO()
+    detaching_pickler()(out, pickle.HIGHEST_PROTOCOL).dump(
+        (ca.uuid, bytes(ca.code), ca.arity, ca.xcount, ca.name, ca.ks, labels))
+    return out.getvalue()
+
+def render_detached(payload):
+    import pickle
+    (uuid, code, arity, xcount, name, ks, labels) = pickle.loads(payload)
+    ca = oznodes.CodeArea(uuid, code, arity, xcount, name, None, ks)
+    stream = opcodes.InstructionStream(ca.code, ca.ks)
+    return (render_codearea(ca, stream, labels), stream.pcs, stream.opcodes)
+
+def render_parallel(codeareas, executor, jobs, cache=None, labels=False):
+    # Yields the same texts as the serial path, in the same order. Cached
+    # procedures and those whose constants cannot be pickled (e.g. too deep)
+    # are rendered here, the others by the workers. With a cache, repeated
+    # procedures are only sent once.
+    import pickle
+    keys = [None] * len(codeareas)
+    texts = [None] * len(codeareas)
+    first = {}
+    payloads = []
+    for i, ca in enumerate(codeareas):
+        if cache is not None:
+            keys[i] = cache_key(ca, labels)
+            if keys[i] in first:
+                continue
+            first[keys[i]] = i
+            texts[i] = cache.get(keys[i])
+            if texts[i] is not None:
+                continue
+        try:
+            payloads.append(detach_codearea(ca, labels))
+        except (pickle.PicklingError, RecursionError, TypeError):
+            stream = opcodes.InstructionStream(ca.code, ca.ks)
+            texts[i] = render_codearea(ca, stream, labels)
+            if cache is not None:
+                cache.put(keys[i], texts[i], stream.pcs, stream.opcodes)
 
-    if lst and lst[0] == 'codearea':
-        ca = lst[2]
-        name = ca['name']
-        if state.filter is None or name == state.filter:
-            args = ' '.join(map('X{}'.format, range(ca['arity'])))
-            print('asm proc {{{} {}}}'.format(ca['name'] or '$', args))
-            if ca['xcount'] > ca['arity']:
-                print(' ', ' '.join(map('X{}'.format, range(ca['arity'], ca['xcount']))))
-                print('in')
-            for pc, opcode in opcodes.to_opcodes(ca['code'], ca['ks']):
-                opcode_str = str(opcode)
-                opcode_prefix = '  /* {:4} */    '.format(pc)
-                for line in opcode_str.split('\n'):
-                    print(opcode_prefix, line)
-            print('  /* {:4} */\nend\n'.format(len(ca['code'])//2))
-
-        lst = ca['ks']
-
-    for item in lst:
-        dump_codearea(item, state)
-
-
-@dump_codearea.register(tuple)
-@dump_codearea.register(dict)
-def _(tup, state):
-    if visit_object(tup, state):
+    chunksize = max(1, len(payloads) // (jobs * 8))
+    results = executor.map(render_detached, payloads, chunksize=chunksize)
+    for i, text in enumerate(texts):
+        if text is None:
+            j = first.get(keys[i], i)
+            if j != i:
+                text = texts[j]
+            else:
+                (text, pcs, ops) = next(results)
+                if cache is not None:
+                    cache.put(keys[i], text, pcs, ops)
+            texts[i] = text
+        yield text
+
+def render_codearea(ca, stream=None, labels=False, stats=None):
+    # decoding errors are printed too, so they are captured with the code.
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        if stats is None:
+            write_codearea(ca, stream or opcodes.InstructionStream(ca.code, ca.ks), out, labels)
+        else:
+            # decoded up front, so that decoding and rendering are timed apart.
+            with stats.phase('decode'):
+                stream = stream or opcodes.InstructionStream(ca.code, ca.ks)
+                ops = list(stream)
+            stats.instructions += len(ops)
+            with stats.phase('render'):
+                write_codearea(ca, stream, out, labels, ops)
+    return out.getvalue()
+
+# the prefixes of the pcs below this bound are formatted once and kept, the
+# others on each use, so that the table stays small in long-lived processes.
+MAX_CACHED_PC = 16384
+_PC_PREFIXES = []
+
+def pc_prefix(pc):
+    if pc >= len(_PC_PREFIXES):
+        if pc >= MAX_CACHED_PC:
+            return '  /* {:4} */     '.format(pc)
+        _PC_PREFIXES.extend(map('  /* {:4} */     '.format,
+                                range(len(_PC_PREFIXES), min(pc + 256, MAX_CACHED_PC))))
+    return _PC_PREFIXES[pc]
+
+def codearea_header(ca):
+    args = ' '.join(map('X{}'.format, range(ca.arity)))
+    header = 'asm proc {{{} {}}}\n'.format(ca.name or '$', args)
+    if ca.xcount > ca.arity:
+        header += '  ' + ' '.join(map('X{}'.format, range(ca.arity, ca.xcount))) + '\nin\n'
+    return header
+
+def write_codearea(ca, stream, out, labels=False, ops=None):
+    write = out.write
+    write(codearea_header(ca))
+    targets = stream.branch_targets() if labels else ()
+    for pc, opcode in stream if ops is None else ops:
+        if pc in targets:
+            write('lbl({}):\n'.format(pc))
+        opcode_str = str(opcode)
+        prefix = pc_prefix(pc)
+        if '\n' in opcode_str:
+            opcode_str = opcode_str.replace('\n', '\n' + prefix)
+        write(prefix + opcode_str + '\n')
+    write('  /* {:4} */\nend\n\n'.format(len(ca.code)//2))
+
+def read_file(fileobj, stats):
+    with timed(stats, 'read'):
+        (buf, offset) = ozpickle.map_file(fileobj)
+        if buf is None:
+            (buf, offset) = (fileobj.read(), 0)
+    if stats is not None:
+        stats.files += 1
+        stats.bytes_read += len(buf) - offset
+    return ozpickle.BufferUnpickler(buf, offset)
+
+def load_table(fileobj, stats):
+    unpickler = read_file(fileobj, stats)
+    with timed(stats, 'unpickle'):
+        node_table = unpickler.scan()
+    if stats is not None:
+        stats.count_nodes(node_table.type_names())
+    return node_table
+
+def load_codeareas(fileobj, stats):
+    # the codeareas reachable from the root, pure data left unvisited.
+    unpickler = read_file(fileobj, stats)
+    with timed(stats, 'unpickle'):
+        (nodes, result_index) = unpickler.read_nodes()
+    if stats is not None:
+        stats.count_nodes(ozpickle.type_name(node) for node in nodes
+                          if type(node) is not ozpickle.Cell)
+        stats.count_deduplicated(unpickler)
+    with timed(stats, 'resolve'):
+        flags = ozpickle.code_flags(nodes)
+        root = ozpickle.resolve(nodes[result_index], nodes, set())
+        code_ids = set(id(nodes[i]) for i in range(len(nodes)) if flags[i])
+        return find_codeareas(root, code_ids)
+
+# codeareas rendered together in --stream mode, bounding the memory used.
+STREAM_BATCH = 256
+
+def disassemble_stream(fileobj, ns):
+    # Each codearea is disassembled as it is read, in file order, with the
+    # constants it refers to shown as <Node N>: the rest of the graph is
+    # never built.
+    stats = ns.stats
+    matchers = [name_matcher(pattern) for pattern in ns.filter or ()]
+    events = ozpickle.iter_events(fileobj)
+    if stats is not None:
+        stats.files += 1
+        events = timed_iter(events, stats, 'unpickle')
+    batch = []
+    for (index, type_name, node) in events:
+        if stats is not None:
+            stats.node_counts[type_name] += 1
+        if type_name != 'codearea' or matchers and not any(m(node.name) for m in matchers):
+            continue
+        if ns.list:
+            print('{}/{}\txcount={}\tsize={}'.format(node.name or '$', node.arity, node.xcount,
+                                                     len(node.code) // 2))
+            continue
+        batch.append(node)
+        if len(batch) == STREAM_BATCH:
+            print_codeareas(batch, ns)
+            batch = []
+    print_codeareas(batch, ns)
+
+def load_cached(load, fileobj, ns):
+    # With a cache of parsed files (see ozfd.py), a file seen unchanged
+    # (same path, mtime and size) is not parsed again.
+    if ns.files is None:
+        return load(fileobj, ns.stats)
+    try:
+        st = os.fstat(fileobj.fileno())
+        key = (load.__name__, os.path.realpath(fileobj.name), st.st_mtime_ns, st.st_size)
+    except (AttributeError, OSError, TypeError, io.UnsupportedOperation):
+        return load(fileobj, ns.stats)
+    value = ns.files.get(key)
+    if value is None:
+        value = load(fileobj, ns.stats)
+        ns.files.put(key, value)
+    return value
+
+def disassemble_file(fileobj, ns):
+    if ns.dedupe:
+        # references only point within the same file.
+        ns.bodies = {}
+    if ns.stream:
+        disassemble_stream(fileobj, ns)
+    elif ns.list:
+        node_table = load_cached(load_table, fileobj, ns)
+        list_codeareas(node_table, ns)
+    elif ns.opcode_stats or ns.uses is not None:
+        import opstats
+        node_table = load_cached(load_table, fileobj, ns)
+        infos = select_codeareas(node_table.codearea_index(), ns.filter)
+        stats = opstats.OpcodeStats(node_table[info.index] for info in infos)
+        if ns.uses is not None:
+            for ca in stats.users(ns.uses):
+                print('{}/{}'.format(ca.name or '$', ca.arity))
+        else:
+            opstats.print_report(stats)
+    elif ns.filter is not None:
+        node_table = load_cached(load_table, fileobj, ns)
+        disassemble_filtered(node_table, ns)
+    else:
+        print_codeareas(load_cached(load_codeareas, fileobj, ns), ns)
         return
+    if ns.stats is not None:
+        # the lazy table only reads the nodes used.
+        ns.stats.count_deduplicated(node_table.unpickler)
+
+def expand_inputs(paths):
+    # (path, name relative to the directory or glob it was found in).
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith('.ozf'):
+                        full_path = os.path.join(root, name)
+                        yield (full_path, os.path.relpath(full_path, path))
+        elif glob.has_magic(path):
+            for full_path in sorted(glob.glob(path, recursive=True)):
+                yield (full_path, os.path.basename(full_path))
+        else:
+            yield (path, os.path.basename(path))
+
+def output_path(output_dir, name):
+    if name.endswith('.ozf'):
+        name = name[:-4]
+    return os.path.join(output_dir, name + '.asm')
 
-    values = tup if not isinstance(tup, dict) else tup.values()
-    for item in values:
-        dump_codearea(item, state)
+def open_input(path):
+    if path == '-':
+        return contextlib.nullcontext(sys.stdin.buffer)
+    return open(path, 'rb')
 
+def disassemble_batch(inputs, ns):
+    # Returns whether all the files could be read. A file which cannot be
+    # read or decoded, e.g. malformed, is reported and skipped, its partial
+    # output removed.
+    success = True
+    for path, name in inputs:
+        out_path = None
+        try:
+            with open_input(path) as f:
+                if ns.output_dir is None:
+                    print('%%% {}'.format(path))
+                    disassemble_file(f, ns)
+                    continue
+                out_path = output_path(ns.output_dir, name)
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                with open(out_path, 'w', buffering=ns.buffer_size) as out, \
+                        contextlib.redirect_stdout(out):
+                    disassemble_file(f, ns)
+        except Exception as e:
+            if isinstance(e, (OSError, ValueError, EOFError)):
+                print('{}: {}'.format(path, e), file=sys.stderr)
+            else:
+                print('{}: {}: {}'.format(path, type(e).__name__, e), file=sys.stderr)
+            if out_path is not None and os.path.exists(out_path):
+                os.unlink(out_path)
+            success = False
+    return success
 
-def main(args=None):
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+def open_output(path, buffer_size):
+    # the output is written in chunks of `buffer_size` bytes.
+    if path is None or path == '-':
+        try:
+            fileno = sys.stdout.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            # redirected to memory, e.g. by ozfd.py.
+            return contextlib.nullcontext(sys.stdout)
+        return open(fileno, 'w', buffering=buffer_size, encoding=sys.stdout.encoding,
+                    errors=sys.stdout.errors, closefd=False)
+    return open(path, 'w', buffering=buffer_size)
+
+def positive_int(text):
+    value = int(text)
+    if value <= 0:
+        raise argparse.ArgumentTypeError('{} is not a positive integer'.format(value))
+    return value
+
+def make_parser():
     parser = argparse.ArgumentParser(description='Disassemble *.ozf files')
-    parser.add_argument('-f', '--filter', help='Keep only procedures with this name')
-    parser.add_argument('ozf', type=argparse.FileType('rb'), help='The file to disassemble')
+    parser.add_argument('-f', '--filter', action='append', metavar='NAME',
+                        help='Keep only procedures with this name, matching this glob '
+                             'or, with a re: prefix, this regular expression (repeatable); '
+                             'printed in file order')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='List the procedures with their arity, X register count and '
+                             'code size instead of the code')
+    parser.add_argument('--opcode-stats', action='store_true',
+                        help='Print opcode and code size statistics instead of the code')
+    parser.add_argument('--uses', type=lambda s: int(s, 0), metavar='OPCODE',
+                        help='List the procedures using this opcode instead of the code')
+    parser.add_argument('--labels', action='store_true',
+                        help='Print a label before every jump target')
+    parser.add_argument('--cfg', choices=['dot', 'json'],
+                        help='Print the control-flow graph of each procedure instead of the code')
+    parser.add_argument('--stream', action='store_true',
+                        help='Disassemble each procedure as soon as it is read, in file order, '
+                             'without building the whole graph: constants show as <Node N>')
+    parser.add_argument('--diff', action='store_true',
+                        help='Compare two builds of a file, OLD and NEW: print the instructions '
+                             'of the changed procedures which differ, and the added and removed ones')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Disassemble procedures with the same code and constants once, '
+                             'the others referring to the first one')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='Disassemble with N worker processes')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='Write the output to FILE instead of the standard output')
+    parser.add_argument('-O', '--output-dir', metavar='DIR',
+                        help='Write one *.asm file per input into DIR')
+    parser.add_argument('--buffer-size', type=positive_int, default=DEFAULT_BUFFER_SIZE,
+                        metavar='BYTES',
+                        help='Size of the output buffer (default: %(default)s)')
+    parser.add_argument('--cache', nargs='?', const='', metavar='PATH',
+                        help='Reuse the disassembly of unchanged procedures from this cache '
+                             '(default: {})'.format(codecache.default_path()))
+    parser.add_argument('--cache-size', type=int, default=codecache.DEFAULT_MAX_SIZE // 2**20,
+                        metavar='MB', help='Maximum size of the cache (default: %(default)s)')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print the time and memory used by each phase, and counters, '
+                             'to the standard error')
+    parser.add_argument('--profile', nargs='?', const='disasm', metavar='PREFIX',
+                        help='Profile the run with cProfile and tracemalloc, writing '
+                             'PREFIX.pstats and PREFIX.tracemalloc (default: %(const)s)')
+    parser.add_argument('ozf', nargs='+',
+                        help='The files to disassemble, directories of them or glob patterns '
+                             '(- for the standard input)')
+    return parser
+
+def main(args=None, files=None, cache=None):
+    # `files` and `cache` are kept across calls by ozfd.py: the parsed
+    # files and the rendered codeareas, replacing --cache.
+    parser = make_parser()
     ns = parser.parse_args(args)
+    if ns.stream and (ns.opcode_stats or ns.uses is not None):
+        parser.error('--opcode-stats and --uses are not available with --stream')
+    if ns.diff and len(ns.ozf) != 2:
+        parser.error('--diff takes two files, OLD and NEW')
+    if ns.diff and (ns.stream or ns.list or ns.opcode_stats or ns.uses is not None or
+                    ns.cfg is not None or ns.output_dir is not None):
+        parser.error('--diff is only available with -f, -o and --stats')
+
+    inputs = list(expand_inputs(ns.ozf)) if not ns.diff else []
+    is_batch = not ns.diff and (ns.output_dir is not None or len(inputs) != 1 or
+                                inputs[0][0] != ns.ozf[0])
+    ns.files = files
+    ns.bodies = None
+    if cache is not None:
+        ns.cache = cache
+    elif ns.cache is not None:
+        ns.cache = codecache.open_cache(ns.cache or None, ns.cache_size * 2**20)
+    if is_batch and cache is None:
+        # procedures repeated across the files are disassembled once.
+        ns.cache = codecache.MemoryCache(ns.cache)
+    ns.executor = None
+    if ns.jobs > 1:
+        import concurrent.futures
+        ns.executor = concurrent.futures.ProcessPoolExecutor(ns.jobs)
+    ns.stats = perfstats.Stats() if ns.stats else None
+    if ns.stats is not None and ns.dedupe:
+        ns.stats.same_body = 0
+    if ns.profile is not None:
+        import cProfile
+        import tracemalloc
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-    content = ozpickle.load(ns.ozf)
-    disassemble(content, ns)
+    try:
+        with open_output(ns.output, ns.buffer_size) as out, contextlib.redirect_stdout(out):
+            if ns.diff:
+                try:
+                    diff_files(ns.ozf[0], ns.ozf[1], ns)
+                except OSError as e:
+                    parser.error(str(e))
+            elif not is_batch:
+                try:
+                    f = open_input(inputs[0][0])
+                except OSError as e:
+                    parser.error("can't open '{}': {}".format(inputs[0][0], e))
+                with f as fileobj:
+                    disassemble_file(fileobj, ns)
+            elif not disassemble_batch(inputs, ns):
+                sys.exit(1)
+    finally:
+        if ns.executor is not None:
+            ns.executor.shutdown()
+        if ns.cache is not None and cache is None:
+            ns.cache.close()
+        if ns.profile is not None:
+            profiler.disable()
+            profiler.dump_stats(ns.profile + '.pstats')
+            tracemalloc.take_snapshot().dump(ns.profile + '.tracemalloc')
+            tracemalloc.stop()
+        if ns.stats is not None:
+            ns.stats.print_report(sys.stderr)
+    return ns.stats
 
 if __name__ == '__main__':
     main()
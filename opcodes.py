@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
 import array
+import collections
 import sys
-import ozpickle
-from uuid import UUID
+from oznodes import WILDCARD, Cons, Tuple, Record, Abstraction, Reg
 from ozify import ozify
 
 class OpSkip:
@@ -147,200 +147,326 @@ class OpInlineGetClass:
 
 #-------------------------------------------------------------------------------
 
-def decode(opcode, arr, pc, ks):
-    def rpc(regclass, delta):
-        num = arr[pc+delta]
-        if regclass == 'K':
-            return ks[num]
-        else:
-            return ['reg', regclass, num]
-
-    def intpc(delta):
-        return arr[pc+delta]
-
-    def pattern_match(regclass):
-        value = rpc(regclass, 1)
-        pattern_value = ks[intpc(2)]
-        patterns = []
-        target_pcs = []
-        for _, _, (pattern, dpc) in ks[intpc(2)][2]:
-            patterns.append(pattern)
-            target_pcs.append(pc + 3 + dpc)
-        return OpCondBranch(value, patterns, target_pcs)
-
-    def cond_branch(dfalse, delse):
+# An opcode is described by its mnemonic and the kinds of its fixed operands,
+# one character per 16-bit word following the opcode:
+#
+#   X, Y, G  register of that class
+#   K        index into the constants table of the codearea
+#   n        immediate integer
+#
+# Variable-length instructions also provide a function measuring their total
+# length, and jumps a function listing their target pcs. A decoder is
+# generated for each entry which reads the operands and passes them to
+# `build(pc, *operands)`.
+
+OpcodeInfo = collections.namedtuple('OpcodeInfo', ['opcode', 'name', 'operands', 'length',
+                                                   'measure', 'decoder', 'targets'])
+
+_REGS = {'X': [], 'Y': [], 'G': []}
+
+def reg(regclass, num):
+    regs = _REGS[regclass]
+    while len(regs) <= num:
+        regs.append(Reg(regclass, len(regs)))
+    return regs[num]
+
+OPERAND_READERS = {
+    'X': lambda num, ks: reg('X', num),
+    'Y': lambda num, ks: reg('Y', num),
+    'G': lambda num, ks: reg('G', num),
+    'K': lambda num, ks: ks[num],
+    'n': lambda num, ks: num,
+}
+
+def make_decoder(operands, build):
+    readers = [OPERAND_READERS[kind] for kind in operands]
+    if not readers:
+        def decoder(arr, pc, ks):
+            return build(pc)
+    elif len(readers) == 1:
+        (r1,) = readers
+        def decoder(arr, pc, ks):
+            return build(pc, r1(arr[pc+1], ks))
+    elif len(readers) == 2:
+        (r1, r2) = readers
+        def decoder(arr, pc, ks):
+            return build(pc, r1(arr[pc+1], ks), r2(arr[pc+2], ks))
+    elif len(readers) == 3:
+        (r1, r2, r3) = readers
+        def decoder(arr, pc, ks):
+            return build(pc, r1(arr[pc+1], ks), r2(arr[pc+2], ks), r3(arr[pc+3], ks))
+    else:
+        def decoder(arr, pc, ks):
+            return build(pc, *[r(arr[pc+i], ks) for i, r in enumerate(readers, 1)])
+    return decoder
+
+OPCODES = [None] * 0x100
+
+def define(opcode, name, operands, build, measure=None, decoder=None, targets=None):
+    length = None if measure else 1 + len(operands)
+    OPCODES[opcode] = OpcodeInfo(opcode, name, operands, length, measure,
+                                 decoder or make_decoder(operands, build), targets)
+
+
+def pattern_match(pc, value, table):
+    if not isinstance(table, Tuple):
+        # not resolved (see `disasm.py --stream`), the targets are unknown.
+        return OpCondBranch(value, [table], ['?'])
+    patterns = []
+    target_pcs = []
+    for entry in table.contents:
+        (pattern, dpc) = entry.contents
+        patterns.append(pattern)
+        target_pcs.append(pc + 3 + dpc)
+    return OpCondBranch(value, patterns, target_pcs)
+
+def pattern_match_targets(arr, pc, ks):
+    table = ks[arr[pc+2]]
+    if not isinstance(table, Tuple):
+        return []
+    return [pc + 3 + entry.contents[1] for entry in table.contents]
+
+def cond_branch(pc, value, dfalse, delse):
+    base = pc + 4
+    return OpCondBranch(value, [True, False], [base, base + dfalse], else_pc=base + delse)
+
+def cond_branch_targets(false_sign, else_sign):
+    def targets(arr, pc, ks):
         base = pc + 4
-        return OpCondBranch(rpc('X', 1),
-                            [True, False],
-                            [base, base + dfalse],
-                            else_pc=base + delse)
+        return [base, base + false_sign*arr[pc+2], base + else_sign*arr[pc+3]]
+    return targets
+
+def call(is_tail_call):
+    def build(pc, func, args_count):
+        args = [reg('X', i) for i in range(args_count)]
+        return OpCall(func, args, is_tail_call=is_tail_call)
+    return build
+
+def send_msg(is_tail_call):
+    def build(pc, receiver, arity, width):
+        msg = Record(arity, [reg('X', i) for i in range(width)])
+        msg.normalize()
+        return OpCall(receiver, [msg], is_tail_call=is_tail_call)
+    return build
+
+def measure_call_builtin(arr, pc):
+    return 3 + arr[pc+2]
+
+def decode_call_builtin(arr, pc, ks):
+    args = [reg('X', arr[pc+i]) for i in range(3, measure_call_builtin(arr, pc))]
+    return OpCall(ks[arr[pc+1]], args)
+
+CREATE_STRUCT_KINDS = ['abstraction', 'cons', 'tuple', 'record']
+CREATE_STRUCT_TARGETS = [('X', False), ('Y', False), ('X', True), ('Y', True), ('G', True), ('K', True)]
+CREATE_STRUCT_SOURCES = ['X', 'Y', 'G', 'K', '?X', '?Y']
+
+def measure_create_struct(arr, pc):
+    length = arr[pc+2]
+    i = 0
+    pc_delta = 4
+    while i < length:
+        sub_op = arr[pc+pc_delta]
+        if sub_op < 6:
+            i += 1
+        elif sub_op == 6:
+            i += arr[pc+pc_delta+1]
+        else:
+            raise ValueError('Unknown sub-opcode for OpCreateStruct')
+        pc_delta += 2
+    return pc_delta
+
+def decode_create_struct(arr, pc, ks):
+    opcode = arr[pc]
+    what = CREATE_STRUCT_KINDS[opcode & 3]
+    (target, is_unify) = CREATE_STRUCT_TARGETS[(opcode >> 2) & 7]
+    label = ks[arr[pc+1]] if what != 'cons' else None
+
+    contents = []
+    for pc_delta in range(4, measure_create_struct(arr, pc), 2):
+        sub_op = arr[pc+pc_delta]
+        num = arr[pc+pc_delta+1]
+        if sub_op < 6:
+            regclass = CREATE_STRUCT_SOURCES[sub_op]
+            contents.append(ks[num] if regclass == 'K' else Reg(regclass, num))
+        else:
+            contents.extend([WILDCARD] * num)
+
+    if what == 'cons':
+        src = Cons(*contents)
+    elif what == 'abstraction':
+        src = Abstraction(None, label, contents)
+    elif what == 'tuple':
+        src = Tuple(label, contents)
+    else:
+        src = Record(label, contents)
+        src.normalize()
+
+    target_num = arr[pc+3]
+    target_reg = ks[target_num] if target == 'K' else reg(target, target_num)
+    return OpMove(src, target_reg, is_unify=is_unify)
+
+
+define(0x00, 'skip', '', lambda pc: OpSkip())
+for opcode, operands in enumerate(['XX', 'XY', 'YX', 'YY', 'GX', 'GY', 'KX', 'KY'], 0x01):
+    define(opcode, 'move' + operands, operands, lambda pc, src, target: OpMove(src, target))
+for opcode, operands in enumerate(['XYXY', 'YXYX', 'YXXY', 'XYYX'], 0x09):
+    define(opcode, 'moveMove' + operands, operands, lambda pc, s1, t1, s2, t2: OpMoveMove(s1, t1, s2, t2))
+define(0x0d, 'allocateY', 'n', lambda pc, count: OpAllocate([reg('Y', n) for n in range(count)]))
+define(0x0f, 'createVarX', 'X', lambda pc, target: OpCreateVar(target))
+define(0x10, 'createVarY', 'Y', lambda pc, target: OpCreateVar(target))
+define(0x11, 'createVarMoveX', 'XX', lambda pc, t1, t2: OpCreateVarMove(t1, t2))
+define(0x12, 'createVarMoveY', 'YX', lambda pc, t1, t2: OpCreateVarMove(t1, t2))
+define(0x18, 'setupExceptionHandler', '', lambda pc: OpSetupExceptionHandler())
+define(0x19, 'popExceptionHandler', '', lambda pc: OpPopExceptionHandler())
+for count in range(6):
+    define(0x20 + count, 'callBuiltin{}'.format(count), 'K' + 'X'*count,
+           lambda pc, func, *args: OpCall(func, list(args)))
+define(0x26, 'callBuiltin', 'Kn', None, measure=measure_call_builtin, decoder=decode_call_builtin)
+for opcode, regclass in enumerate('XYGK', 0x27):
+    define(opcode, 'call' + regclass, regclass + 'n', call(False))
+    define(opcode + 4, 'tailCall' + regclass, regclass + 'n', call(True))
+for opcode, regclass in enumerate('XYGK', 0x30):
+    define(opcode, 'sendMsg' + regclass, regclass + 'Kn', send_msg(False))
+    define(opcode + 4, 'tailSendMsg' + regclass, regclass + 'Kn', send_msg(True))
+define(0x40, 'return', '', lambda pc: OpReturn())
+define(0x41, 'branch', 'n', lambda pc, delta: OpBranch(pc + 2 + delta),
+       targets=lambda arr, pc, ks: [pc + 2 + arr[pc+1]])
+define(0x42, 'branchBackward', 'n', lambda pc, delta: OpBranch(pc + 2 - delta),
+       targets=lambda arr, pc, ks: [pc + 2 - arr[pc+1]])
+define(0x43, 'condBranch', 'Xnn', lambda pc, x, f, e: cond_branch(pc, x, f, e),
+       targets=cond_branch_targets(1, 1))
+define(0x44, 'condBranchFB', 'Xnn', lambda pc, x, f, e: cond_branch(pc, x, f, -e),
+       targets=cond_branch_targets(1, -1))
+define(0x45, 'condBranchBF', 'Xnn', lambda pc, x, f, e: cond_branch(pc, x, -f, e),
+       targets=cond_branch_targets(-1, 1))
+define(0x46, 'condBranchBB', 'Xnn', lambda pc, x, f, e: cond_branch(pc, x, -f, -e),
+       targets=cond_branch_targets(-1, -1))
+for opcode, regclass in enumerate('XYG', 0x47):
+    define(opcode, 'patternMatch' + regclass, regclass + 'K', pattern_match,
+           targets=pattern_match_targets)
+for opcode, operands in enumerate(['XX', 'XY', 'XG', 'XK', 'YY', 'YG', 'YK', 'GG', 'GK', 'KK'], 0x50):
+    define(opcode, 'unify' + operands, operands, lambda pc, a, b: OpMove(a, b, is_unify=True))
+for opcode in range(0x60, 0x78):
+    (target, is_unify) = CREATE_STRUCT_TARGETS[(opcode >> 2) & 7]
+    define(opcode, 'create{}{}{}'.format(CREATE_STRUCT_KINDS[opcode & 3].title(),
+                                         'Unify' if is_unify else 'Store', target),
+           'Kn' + target, None, measure=measure_create_struct, decoder=decode_create_struct)
+define(0x80, 'inlineEqualsInteger', 'Xnn',
+       lambda pc, x, value, delta: OpCondBranch(x, [value], [pc + 4], else_pc=pc + 4 + delta),
+       targets=lambda arr, pc, ks: [pc + 4, pc + 4 + arr[pc+3]])
+define(0x81, 'inlinePlus', 'XXX', lambda pc, a, b, r: OpInlineBinArith(a, '+', b, r))
+define(0x82, 'inlineMinus', 'XXX', lambda pc, a, b, r: OpInlineBinArith(a, '-', b, r))
+define(0x83, 'inlinePlus1', 'XX', lambda pc, a, r: OpInlineBinArith(a, '+', 1, r))
+define(0x84, 'inlineMinus1', 'XX', lambda pc, a, r: OpInlineBinArith(a, '-', 1, r))
+define(0x90, 'inlineGetClass', 'XX', lambda pc, src, target: OpInlineGetClass(src, target))
+
+
+def instruction_length(arr, pc):
+    info = OPCODES[arr[pc]]
+    return info.length or info.measure(arr, pc)
 
-    def equals_integer():
-        base = pc + 4
-        return OpCondBranch(rpc('X', 1), [intpc(2)], [base], else_pc=base+intpc(3))
-
-    def call(regclass, is_tail_call=False):
-        args = [['reg', 'X', i] for i in range(intpc(2))]
-        return OpCall(rpc(regclass, 1), args, is_tail_call=is_tail_call)
-
-    def send_msg(regclass, is_tail_call=False):
-        arity = rpc('K', 2)
-        args = [['reg', 'X', i] for i in range(intpc(2))]
-        msg = ['record/prenormalized', arity, args]
-        ozpickle.normalize_record(msg)
-        return OpCall(rpc(regclass, 1), [msg], is_tail_call=is_tail_call)
-
-    def call_builtin():
-        args_count = intpc(2)
-        args = [rpc('X', n) for n in range(3, 3+args_count)]
-        return (2 + args_count, OpCall(rpc('K', 1), args))
-
-    DECODERS = {
-        0x00: lambda: (0, OpSkip()),
-        0x01: lambda: (2, OpMove(rpc('X', 1), rpc('X', 2))),
-        0x02: lambda: (2, OpMove(rpc('X', 1), rpc('Y', 2))),
-        0x03: lambda: (2, OpMove(rpc('Y', 1), rpc('X', 2))),
-        0x04: lambda: (2, OpMove(rpc('Y', 1), rpc('Y', 2))),
-        0x05: lambda: (2, OpMove(rpc('G', 1), rpc('X', 2))),
-        0x06: lambda: (2, OpMove(rpc('G', 1), rpc('Y', 2))),
-        0x07: lambda: (2, OpMove(rpc('K', 1), rpc('X', 2))),
-        0x08: lambda: (2, OpMove(rpc('K', 1), rpc('Y', 2))),
-        0x09: lambda: (4, OpMoveMove(rpc('X', 1), rpc('Y', 2), rpc('X', 3), rpc('Y', 4))),
-        0x0a: lambda: (4, OpMoveMove(rpc('Y', 1), rpc('X', 2), rpc('Y', 3), rpc('X', 4))),
-        0x0b: lambda: (4, OpMoveMove(rpc('Y', 1), rpc('X', 2), rpc('X', 3), rpc('Y', 4))),
-        0x0c: lambda: (4, OpMoveMove(rpc('X', 1), rpc('Y', 2), rpc('Y', 3), rpc('X', 4))),
-        0x0d: lambda: (1, OpAllocate([['reg', 'Y', n] for n in range(intpc(1))])),
-        0x0f: lambda: (1, OpCreateVar(rpc('X', 1))),
-        0x10: lambda: (1, OpCreateVar(rpc('Y', 1))),
-        0x11: lambda: (2, OpCreateVarMove(rpc('X', 1), rpc('X', 2))),
-        0x12: lambda: (2, OpCreateVarMove(rpc('Y', 1), rpc('X', 2))),
-        0x18: lambda: (0, OpSetupExceptionHandler()),
-        0x19: lambda: (0, OpPopExceptionHandler()),
-        0x20: lambda: (1, OpCall(rpc('K', 1), [])),
-        0x21: lambda: (2, OpCall(rpc('K', 1), [rpc('X', 2)])),
-        0x22: lambda: (3, OpCall(rpc('K', 1), [rpc('X', n) for n in range(2, 4)])),
-        0x23: lambda: (4, OpCall(rpc('K', 1), [rpc('X', n) for n in range(2, 5)])),
-        0x24: lambda: (5, OpCall(rpc('K', 1), [rpc('X', n) for n in range(2, 6)])),
-        0x25: lambda: (6, OpCall(rpc('K', 1), [rpc('X', n) for n in range(2, 7)])),
-        0x26: call_builtin,
-        0x27: lambda: (2, call('X')),
-        0x28: lambda: (2, call('Y')),
-        0x29: lambda: (2, call('G')),
-        0x2a: lambda: (2, call('K')),
-        0x2b: lambda: (2, call('X', is_tail_call=True)),
-        0x2c: lambda: (2, call('Y', is_tail_call=True)),
-        0x2d: lambda: (2, call('G', is_tail_call=True)),
-        0x2e: lambda: (2, call('K', is_tail_call=True)),
-        0x30: lambda: (3, send_msg('X')),
-        0x31: lambda: (3, send_msg('Y')),
-        0x32: lambda: (3, send_msg('G')),
-        0x33: lambda: (3, send_msg('K')),
-        0x34: lambda: (3, send_msg('X', is_tail_call=True)),
-        0x35: lambda: (3, send_msg('Y', is_tail_call=True)),
-        0x36: lambda: (3, send_msg('G', is_tail_call=True)),
-        0x37: lambda: (3, send_msg('K', is_tail_call=True)),
-        0x40: lambda: (0, OpReturn()),
-        0x41: lambda: (1, OpBranch(pc + 2 + intpc(1))),
-        0x42: lambda: (1, OpBranch(pc + 2 - intpc(1))),
-        0x43: lambda: (3, cond_branch(intpc(2), intpc(3))),
-        0x44: lambda: (3, cond_branch(intpc(2), -intpc(3))),
-        0x45: lambda: (3, cond_branch(-intpc(2), intpc(3))),
-        0x46: lambda: (3, cond_branch(-intpc(2), -intpc(3))),
-        0x47: lambda: (2, pattern_match('X')),
-        0x48: lambda: (2, pattern_match('Y')),
-        0x49: lambda: (2, pattern_match('G')),
-        0x50: lambda: (2, OpMove(rpc('X', 1), rpc('X', 2), is_unify=True)),
-        0x51: lambda: (2, OpMove(rpc('X', 1), rpc('Y', 2), is_unify=True)),
-        0x52: lambda: (2, OpMove(rpc('X', 1), rpc('G', 2), is_unify=True)),
-        0x53: lambda: (2, OpMove(rpc('X', 1), rpc('K', 2), is_unify=True)),
-        0x54: lambda: (2, OpMove(rpc('Y', 1), rpc('Y', 2), is_unify=True)),
-        0x55: lambda: (2, OpMove(rpc('Y', 1), rpc('G', 2), is_unify=True)),
-        0x56: lambda: (2, OpMove(rpc('Y', 1), rpc('K', 2), is_unify=True)),
-        0x57: lambda: (2, OpMove(rpc('G', 1), rpc('G', 2), is_unify=True)),
-        0x58: lambda: (2, OpMove(rpc('G', 1), rpc('K', 2), is_unify=True)),
-        0x59: lambda: (2, OpMove(rpc('K', 1), rpc('K', 2), is_unify=True)),
-        0x80: lambda: (3, equals_integer()),
-        0x81: lambda: (3, OpInlineBinArith(rpc('X', 1), '+', rpc('X', 2), rpc('X', 3))),
-        0x82: lambda: (3, OpInlineBinArith(rpc('X', 1), '-', rpc('X', 2), rpc('X', 3))),
-        0x83: lambda: (2, OpInlineBinArith(rpc('X', 1), '+', 1, rpc('X', 2))),
-        0x84: lambda: (2, OpInlineBinArith(rpc('X', 1), '-', 1, rpc('X', 2))),
-        0x90: lambda: (2, OpInlineGetClass(rpc('X', 1), rpc('X', 2))),
-    }
-
-    try:
-        if opcode in DECODERS:
-            return DECODERS[opcode]()
-
-        # create struct
-        elif opcode & ~0x1f == 0x60:
-            what = ['abstraction', 'cons', 'tuple', 'record/prenormalized'][opcode & 3]
-
-            (target, is_unify) = [
-                ('X', False),
-                ('Y', False),
-                ('X', True),
-                ('Y', True),
-                ('G', True),
-                ('K', True),
-            ][(opcode >> 2) & 7]
-
-            length = intpc(2)
-            label = rpc('K', 1) if what != 'cons' else None
-            pre_ops = []
-            contents = []
-
-            i = 0
-            pc_delta = 4
-            while i < length:
-                sub_op = intpc(pc_delta)
-
-                if sub_op < 6:
-                    regclass = ['X', 'Y', 'G', 'K', '?X', '?Y'][sub_op]
-                    contents.append(rpc(regclass, pc_delta+1))
-                    i += 1
-                elif sub_op == 6:
-                    count = intpc(pc_delta+1)
-                    contents.extend([['patmatwildcard']] * count)
-                    i += count
-                else:
-                    raise ValueError('Unknown sub-opcode for OpCreateStruct')
-
-                pc_delta += 2
-
-            if what == 'cons':
-                src = contents
-                src.insert(0, 'cons')
-            elif what == 'abstraction':
-                src = ['abstraction', None, {
-                    'codearea': label,
-                    'gs': contents
-                }]
-            else:
-                src = [what, label, contents]
-                ozpickle.normalize_record(src)
+def decode(opcode, arr, pc, ks):
+    info = OPCODES[opcode] if opcode < len(OPCODES) else None
+    if info is None:
+        if opcode <= 0x90:
+            raise ValueError(hex(opcode))
+    else:
+        try:
+            return (instruction_length(arr, pc) - 1, info.decoder(arr, pc, ks))
+        except Exception as e:
+            print(e)
 
-            return (pc_delta-1, OpMove(src, rpc(target, 3), is_unify=is_unify))
+    length = len(arr) - pc - 1
+    return (length, OpUnknown(arr[pc:]))
 
-    except Exception as e:
-        print(e)
-        pass
 
-    if opcode <= 0x90 and opcode not in DECODERS:
-        raise ValueError(hex(opcode))
+CALL_OPCODES = frozenset(list(range(0x20, 0x2f)) + list(range(0x30, 0x38)))
 
-    length = len(arr) - pc - 1
-    return (length, OpUnknown(arr[pc:]))
 
+def code_words(b):
+    # The code is a sequence of big-endian 16-bit words. On big-endian hosts
+    # this is a view of the buffer; elsewhere the words must be swapped once.
+    if sys.byteorder == 'big':
+        return memoryview(b).cast('B').cast('H')
 
-def to_opcodes(b, ks):
     arr = array.array('H')
     if arr.itemsize != 2:
         raise TypeError('"unsigned short" is not 2 bytes.')
-
     arr.frombytes(b)
-    if sys.byteorder != 'big':
-        arr.byteswap()
+    arr.byteswap()
+    return arr
+
+
+class InstructionStream:
+    # The instructions of a codearea as parallel arrays of pc, opcode and
+    # length. Op objects are only decoded on request.
+
+    def __init__(self, code, ks):
+        self.words = code_words(code)
+        self.ks = ks
+        self.pcs = array.array('I')
+        self.opcodes = array.array('H')
+        self.lengths = array.array('I')
+
+        words = self.words
+        program_size = len(words)
+        pc = 0
+        while pc < program_size:
+            opcode = words[pc]
+            info = OPCODES[opcode] if opcode < len(OPCODES) else None
+            try:
+                length = info.length or info.measure(words, pc)
+            except (AttributeError, IndexError, ValueError):
+                # unknown or malformed, decodes as the rest of the code.
+                length = program_size - pc
+            self.pcs.append(pc)
+            self.opcodes.append(opcode)
+            self.lengths.append(min(length, program_size - pc))
+            pc += length
+
+    def __len__(self):
+        return len(self.pcs)
+
+    def op(self, i):
+        pc = self.pcs[i]
+        return decode(self.opcodes[i], self.words, pc, self.ks)[1]
+
+    def __iter__(self):
+        words = self.words
+        ks = self.ks
+        for pc, opcode, length in zip(self.pcs, self.opcodes, self.lengths):
+            (pc_inc, code) = decode(opcode, words, pc, ks)
+            yield (pc, code)
+            if pc_inc + 1 != length:
+                # decoding failed and swallowed the remaining code.
+                break
+
+    def indexes(self, opcodes):
+        return [i for i, opcode in enumerate(self.opcodes) if opcode in opcodes]
+
+    def opcode_counts(self):
+        return collections.Counter(self.opcodes)
+
+    def branch_targets(self):
+        targets = set()
+        for pc, opcode in zip(self.pcs, self.opcodes):
+            info = OPCODES[opcode] if opcode < len(OPCODES) else None
+            if info is not None and info.targets is not None:
+                targets.update(info.targets(self.words, pc, self.ks))
+        return targets
+
+    def call_sites(self):
+        # (pc, callee) for every call, the callee being a constant or a register.
+        sites = []
+        for i in self.indexes(CALL_OPCODES):
+            pc = self.pcs[i]
+            kind = OPCODES[self.opcodes[i]].operands[0]
+            sites.append((pc, OPERAND_READERS[kind](self.words[pc+1], self.ks)))
+        return sites
+
 
+def to_opcodes(b, ks):
+    arr = code_words(b)
     program_size = len(arr)
     pc = 0
 
@@ -349,4 +475,3 @@ def to_opcodes(b, ks):
         (pc_inc, code) = decode(opcode, arr, pc, ks)
         yield (pc, code)
         pc += 1 + pc_inc
-
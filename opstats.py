@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Bulk opcode statistics over many codeareas. Uses NumPy when available,
+# and falls back to the pure Python instruction scanner otherwise.
+
+import collections
+import opcodes
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# opcodes above 0xff are unknown and counted together in the last bucket.
+OTHER = 0x100
+
+if numpy is not None:
+    # fixed instruction lengths, 0 for the variable-length or unknown opcodes.
+    FIXED_LENGTHS = numpy.array([(info.length or 0) if info else 0 for info in opcodes.OPCODES] + [0],
+                                dtype=numpy.int64)
+
+def word_lengths(words):
+    # length of the instruction which would start at each word, computed for
+    # every position at once; 0 where it has to be measured while walking.
+    lengths = FIXED_LENGTHS[numpy.minimum(words, OTHER)]
+    builtin_calls = numpy.flatnonzero(words[:-2] == 0x26)
+    lengths[builtin_calls] = 3 + words[builtin_calls + 2]
+    return lengths.tolist()
+
+def walk(words, lengths, begin, end, starts):
+    pc = begin
+    while pc < end:
+        starts.append(pc)
+        length = lengths[pc]
+        if not length:
+            try:
+                length = opcodes.instruction_length(words[begin:end], pc - begin)
+            except (AttributeError, IndexError, ValueError):
+                break
+        pc += length
+
+def instruction_starts(code):
+    if numpy is None:
+        return opcodes.InstructionStream(code, None).pcs
+
+    words = numpy.frombuffer(code, dtype='>u2')
+    starts = []
+    walk(words, word_lengths(words), 0, len(words), starts)
+    return numpy.array(starts, dtype=numpy.int64)
+
+
+class OpcodeStats:
+    def __init__(self, codeareas):
+        self.codeareas = list(codeareas)
+        self.sizes = [len(ca.code) // 2 for ca in self.codeareas]
+        if numpy is None:
+            self.counts = []
+            for ca in self.codeareas:
+                stream = opcodes.InstructionStream(ca.code, None)
+                self.counts.append(collections.Counter(min(op, OTHER) for op in stream.opcodes))
+        else:
+            self.counts = self.count_opcodes()
+
+    def count_opcodes(self):
+        # All the code is concatenated into one array so that the lengths, the
+        # opcodes and their counts are each computed in one vectorized step.
+        # The result has one row of opcode counts per codearea.
+        words = numpy.frombuffer(b''.join(ca.code for ca in self.codeareas), dtype='>u2')
+        offsets = numpy.zeros(len(self.sizes) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.sizes, out=offsets[1:])
+
+        lengths = word_lengths(words)
+        starts = []
+        for begin, end in zip(offsets.tolist(), offsets[1:].tolist()):
+            walk(words, lengths, begin, end, starts)
+
+        starts = numpy.array(starts, dtype=numpy.int64)
+        rows = numpy.searchsorted(offsets, starts, side='right') - 1
+        ops = numpy.minimum(words[starts], OTHER)
+        counts = numpy.bincount(rows * (OTHER + 1) + ops, minlength=len(self.sizes) * (OTHER + 1))
+        return counts.reshape(len(self.sizes), OTHER + 1)
+
+    def histogram(self):
+        if numpy is None:
+            return sum(self.counts, collections.Counter())
+        totals = self.counts.sum(axis=0)
+        return collections.Counter({int(op): int(totals[op]) for op in numpy.flatnonzero(totals)})
+
+    def mask(self, opcode):
+        # the opcodes above 0xff are counted together.
+        opcode = min(opcode, OTHER)
+        if numpy is None:
+            return [bool(counts[opcode]) for counts in self.counts]
+        return self.counts[:, opcode] > 0
+
+    def users(self, opcode):
+        return [ca for ca, used in zip(self.codeareas, self.mask(opcode)) if used]
+
+    def size_histogram(self, bins=10):
+        if numpy is None:
+            # equal-width bins, the same as numpy.histogram.
+            (low, high) = (min(self.sizes, default=0), max(self.sizes, default=1))
+            if low == high:
+                (low, high) = (low - 0.5, high + 0.5)
+            width = (high - low) / bins
+            counts = collections.Counter(min(int((size - low) / width), bins - 1)
+                                         for size in self.sizes)
+            edges = [low + i*width for i in range(bins + 1)]
+            return ([counts[i] for i in range(bins)], edges)
+        (counts, edges) = numpy.histogram(self.sizes, bins=bins)
+        return (counts.tolist(), edges.tolist())
+
+
+def opcode_name(opcode):
+    info = opcodes.OPCODES[opcode] if opcode < OTHER else None
+    return info.name if info else '(unknown)'
+
+def print_report(stats, file=None):
+    histogram = stats.histogram()
+    total = sum(histogram.values())
+    print('codeareas:', len(stats.codeareas), file=file)
+    print('instructions:', total, file=file)
+    print('code words:', sum(stats.sizes), file=file)
+    print(file=file)
+    print('code size distribution (words):', file=file)
+    (counts, edges) = stats.size_histogram()
+    for count, low, high in zip(counts, edges, edges[1:]):
+        print('  {:10.1f} - {:10.1f}  {:8}'.format(low, high, count), file=file)
+    print(file=file)
+    print('opcode histogram:', file=file)
+    for opcode, count in sorted(histogram.items(), key=lambda item: (-item[1], item[0])):
+        users = sum(1 for used in stats.mask(opcode) if used)
+        print('  {:>5}  {:24} {:10} {:6.2f}%  in {} codeareas'.format(
+            hex(opcode) if opcode < OTHER else 'other', opcode_name(opcode),
+            count, 100.0 * count / max(total, 1), users), file=file)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Drop-in replacement for disasm.py which hands the command line to a
+# running ozfd.py, falling back to disassembling in-process when no daemon
+# is listening. Only cheap modules are imported on the fast path.
+
+import base64
+import json
+import os
+import socket
+import stat
+import sys
+
+def default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+    return os.path.join(runtime_dir, 'ozfd-{}.sock'.format(os.getuid()))
+
+def socket_path():
+    return os.environ.get('OZFD_SOCKET') or default_socket_path()
+
+def owned_socket(path):
+    # whether `path` is a socket of this user, and not one another user
+    # could have bound in a shared directory to read the requests.
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        print('ozfc: ignoring {}, not a socket of this user'.format(path), file=sys.stderr)
+        return False
+    return True
+
+def reads_stdin(args):
+    # whether `-` is an input file, and not e.g. the value of -o; disasm is
+    # only imported to parse the command line then.
+    if '-' not in args:
+        return False
+    import disasm
+    return '-' in disasm.make_parser().parse_known_args(args)[0].ozf
+
+def request(args, path=None):
+    # the reply of the daemon, or None if none is running.
+    path = path or socket_path()
+    if not owned_socket(path):
+        return None
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+    except (AttributeError, OSError):
+        return None
+    stdin = sys.stdin.buffer.read() if reads_stdin(args) else None
+    message = {'args': args, 'cwd': os.getcwd(),
+               'stdin': base64.b64encode(stdin).decode('ascii') if stdin is not None else None}
+    with sock, sock.makefile('rwb') as f:
+        f.write(json.dumps(message).encode('utf-8') + b'\n')
+        f.flush()
+        line = f.readline()
+    if not line:
+        raise OSError('ozfd closed the connection')
+    return json.loads(line.decode('utf-8'))
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    reply = request(args)
+    if reply is None:
+        import disasm
+        disasm.main(args)
+        return
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    sys.exit(reply['status'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Disassembly daemon: runs disasm.py command lines sent by ozfc.py on a
+# local Unix socket, keeping the parsed files and the rendered codeareas
+# in memory between requests.
+#
+# Each request is one JSON line {"args": [...], "cwd": ..., "stdin": base64
+# or null}, answered by {"stdout": ..., "stderr": ..., "status": ...}.
+# Connections are served concurrently, but the commands run one at a time
+# in a worker thread since they redirect the standard streams of the process.
+
+import argparse
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import signal
+import sys
+import codecache
+import disasm
+import ozfc
+
+# the largest request, *.ozf files sent on the standard input included.
+MAX_REQUEST = 1024 * 1024 * 1024
+
+class FileCache:
+    # The most recently used parsed files, see disasm.load_cached().
+    def __init__(self, max_files):
+        self.max_files = max_files
+        self.files = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.files.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.files.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.files[key] = value
+        while len(self.files) > self.max_files:
+            self.files.popitem(last=False)
+
+
+class Server:
+    def __init__(self, max_files, cache_path=None):
+        self.files = FileCache(max_files)
+        self.cache_path = cache_path
+        self.cache = None
+        self.worker = concurrent.futures.ThreadPoolExecutor(1)
+
+    def open_cache(self):
+        # in the worker thread, which alone may use the SQLite connection.
+        backing = None
+        if self.cache_path is not None:
+            backing = codecache.open_cache(self.cache_path or None)
+        self.cache = codecache.MemoryCache(backing)
+
+    def close(self):
+        if self.cache is not None:
+            self.worker.submit(self.cache.close).result()
+        self.worker.shutdown()
+
+    def run_command(self, args, cwd, stdin):
+        if self.cache is None:
+            self.open_cache()
+        (out, err) = (io.StringIO(), io.StringIO())
+        status = 0
+        saved_stdin = sys.stdin
+        if stdin is not None:
+            sys.stdin = io.TextIOWrapper(io.BytesIO(stdin))
+        try:
+            os.chdir(cwd)
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                disasm.main(args, self.files, self.cache)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                status = 1
+                err.write('{}\n'.format(e.code))
+        except Exception as e:
+            status = 1
+            err.write('ozfd: {}: {}\n'.format(type(e).__name__, e))
+        finally:
+            sys.stdin = saved_stdin
+            # the other users of the database see the new entries at once.
+            self.cache.flush()
+        return {'stdout': out.getvalue(), 'stderr': err.getvalue(), 'status': status}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line.decode('utf-8'))
+                stdin = message.get('stdin')
+                reply = await asyncio.get_running_loop().run_in_executor(
+                    self.worker, self.run_command, message['args'], message.get('cwd') or '/',
+                    base64.b64decode(stdin) if stdin is not None else None)
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ConnectionError, ValueError, KeyError) as e:
+            print('ozfd: bad request: {}'.format(e), file=sys.stderr)
+        finally:
+            writer.close()
+
+    async def serve(self, path):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        # created private, not only chmod()ed afterwards.
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle, path, limit=MAX_REQUEST)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            os.unlink(path)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Serve disasm.py requests from ozfc.py')
+    parser.add_argument('-s', '--socket', default=ozfc.socket_path(), metavar='PATH',
+                        help='Listen on this Unix socket (default: %(default)s)')
+    parser.add_argument('--max-files', type=int, default=64, metavar='N',
+                        help='Keep up to N parsed files in memory (default: %(default)s)')
+    parser.add_argument('--cache', nargs='?', const='', metavar='PATH',
+                        help='Also keep the rendered codeareas in this cache on disk '
+                             '(default: {})'.format(codecache.default_path()))
+    ns = parser.parse_args(args)
+    # the usage and errors of the commands read as disasm.py's.
+    sys.argv[0] = 'disasm.py'
+
+    server = Server(ns.max_files, ns.cache)
+    try:
+        asyncio.run(server.serve(ns.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Generates synthetic *.ozf files of a controlled size, for benchmarks and
+# for reproducing problems without sharing real files.
+
+import argparse
+import random
+import struct
+import sys
+import ozpickle
+from oznodes import (UNIT, WILDCARD, Cons, Tuple, Record, Builtin, CodeArea, PatMatCapture,
+                     Abstraction, Chunk, UnicodeString)
+
+BUILTINS = [('Value', '.'), ('Value', '=='), ('Number', '+'), ('Number', '-'),
+            ('System', 'show'), ('Record', 'label'), ('Value', 'catAccess')]
+ATOMS = ['nil', 'true', 'false', 'value', 'get', 'put', 'pair', 'Weird Atom', 'end']
+
+def random_uuid(rng):
+    return rng.getrandbits(128).to_bytes(16, 'big')
+
+def make_chain(length):
+    chain = 'nil'
+    for i in range(length):
+        chain = Cons(i, chain)
+    return chain
+
+def make_deep_record(depth):
+    record = UNIT
+    for i in range(depth):
+        record = Record('r', [(1, record), ('level', i)])
+    return record
+
+class CodeAreaGenerator:
+    def __init__(self, rng, ks_size, chain_length, record_depth, same_body=0.0):
+        self.rng = rng
+        self.ks_size = ks_size
+        self.same_body = same_body
+        # shared by all the constants tables.
+        self.chain = make_chain(chain_length) if chain_length else None
+        self.record = make_deep_record(record_depth) if record_depth else None
+        self.previous = []
+
+    def constants(self):
+        rng = self.rng
+        ks = [rng.choice(ATOMS), Builtin(*rng.choice(BUILTINS)), rng.randrange(-10**6, 10**6),
+              rng.random() * 100, UnicodeString('string {}'.format(rng.randrange(100))),
+              Tuple('#', [Tuple('#', [Tuple('pair', [PatMatCapture(3), WILDCARD]), 0]),
+                          Tuple('#', ['nil', 0])]),
+              Chunk(Record('info', [('size', rng.randrange(100))]))]
+        if self.previous:
+            callee = rng.choice(self.previous)
+            ks.append(Abstraction(random_uuid(rng), callee, []))
+        if self.chain is not None:
+            ks.append(self.chain)
+        if self.record is not None:
+            ks.append(self.record)
+        while len(ks) < self.ks_size:
+            ks.append(rng.choice([rng.choice(ATOMS), rng.randrange(1000),
+                                  Builtin(*rng.choice(BUILTINS)),
+                                  Tuple(rng.choice(ATOMS), [rng.randrange(10), 'x'])]))
+        return ks
+
+    def code(self, ks, instructions):
+        # Only valid instructions, referring to the small constants at the
+        # start of the table; the jumps go to the next instruction.
+        rng = self.rng
+        words = []
+        for _ in range(instructions):
+            kind = rng.randrange(8)
+            (x, y) = (rng.randrange(8), rng.randrange(8))
+            if kind == 0:
+                words += [0x01, x, y]                      # moveXX
+            elif kind == 1:
+                words += [0x07, rng.randrange(5), x]       # moveKX
+            elif kind == 2:
+                words += [0x21, 1, x]                      # callBuiltin1
+            elif kind == 3:
+                words += [0x27, x, 2]                      # callX
+            elif kind == 4:
+                words += [0x62, 0, 2, x, 0, y, 3, 2]       # createTupleStoreX
+            elif kind == 5:
+                words += [0x47, x, 5]                      # patternMatchX
+            elif kind == 6:
+                words += [0x41, 0]                         # branch
+            else:
+                words += [0x81, x, y, x]                   # inlinePlus
+        words.append(0x40)
+        return struct.pack('>{}H'.format(len(words)), *words)
+
+    def codearea(self, index, instructions):
+        name = 'Proc{}'.format(index)
+        if self.same_body and self.previous and self.rng.random() < self.same_body:
+            # a copy of an earlier body under another name and UUID.
+            original = self.rng.choice(self.previous)
+            ca = CodeArea(random_uuid(self.rng), original.code, 2, 8, name, UNIT, original.ks)
+        else:
+            ks = self.constants()
+            ca = CodeArea(random_uuid(self.rng), self.code(ks, instructions), 2, 8, name, UNIT, ks)
+        self.previous.append(ca)
+        return ca
+
+
+def generate(codeareas, instructions=50, ks_size=16, chain_length=0, record_depth=0, seed=0,
+             same_body=0.0):
+    # The root is a record exporting an abstraction of every codearea.
+    gen = CodeAreaGenerator(random.Random(seed), ks_size, chain_length, record_depth, same_body)
+    exports = []
+    for i in range(codeareas):
+        ca = gen.codearea(i, instructions)
+        exports.append(('proc{}'.format(i), Abstraction((i + 1).to_bytes(16, 'big'), ca, [])))
+    return Record('export', exports)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic *.ozf file')
+    parser.add_argument('-n', '--codeareas', type=int, default=1000)
+    parser.add_argument('-i', '--instructions', type=int, default=50,
+                        help='Instructions per codearea (default: %(default)s)')
+    parser.add_argument('-k', '--ks-size', type=int, default=16,
+                        help='Constants per codearea (default: %(default)s)')
+    parser.add_argument('--chain', type=int, default=0, metavar='LENGTH',
+                        help='Add a list of this length to the constants tables')
+    parser.add_argument('--depth', type=int, default=0,
+                        help='Add records nested this deep to the constants tables')
+    parser.add_argument('--same-body', type=float, default=0.0, metavar='FRACTION',
+                        help='Copy the code and constants of an earlier codearea into '
+                             'this fraction of them')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', type=argparse.FileType('wb'), default=sys.stdout.buffer)
+    ns = parser.parse_args(args)
+    ozpickle.dump(generate(ns.codeareas, ns.instructions, ns.ks_size, ns.chain, ns.depth, ns.seed,
+                           ns.same_body),
+                  ns.output)
+
+if __name__ == '__main__':
+    main()
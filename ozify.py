@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 
+# Renders Oz values in Oz syntax. Rendering is dispatched on the exact type
+# through RENDERERS; the state of one ozify() call (the nodes already seen
+# and the options) is carried in a Context.
+
 import re
-try:
-    from functools import singledispatch
-except ImportError:
-    from singledispatch import singledispatch
+import functools
+import oznodes
 
 KEYWORDS = frozenset(['andthen', 'at', 'attr', 'case', 'catch', 'choice',
                       'class', 'cond', 'declare', 'define', 'dis', 'div',
@@ -15,69 +17,105 @@ KEYWORDS = frozenset(['andthen', 'at', 'attr', 'case', 'catch', 'choice',
                       'raise', 'require', 'self', 'skip', 'then', 'thread',
                       'true', 'try', 'unit', 'for'])
 
-def ozify_tuple(label, contents, **kwargs):
+ATOM_PATTERN = re.compile('^[a-z][a-z0-9A-Z_]*$')
+ATOM_ESCAPE = re.compile(r"(['\\])")
+STRING_ESCAPE = re.compile(r'(["\\])')
+
+class Context:
+    __slots__ = ('visited', 'is_verbose_abstraction')
+
+    def __init__(self, is_verbose_abstraction=False):
+        self.visited = set()
+        self.is_verbose_abstraction = is_verbose_abstraction
+
+@functools.lru_cache(maxsize=4096)
+def ozify_atom(r):
+    if not ATOM_PATTERN.match(r) or r in KEYWORDS:
+        return "'" + ATOM_ESCAPE.sub(r"\\\1", r) + "'"
+    else:
+        return r
+
+def ozify_number(r, ctx):
+    return str(r).replace('-', '~')
+
+def ozify_tuple(r, ctx):
+    (label, contents) = (r.label, r.contents)
     if label == '#' and len(contents) >= 2:
         contents_strings = []
         for item in contents:
-            item_string = ozify(item, **kwargs)
-            if isinstance(item, list):
+            item_string = render(item, ctx)
+            if isinstance(item, oznodes.Node):
                 item_string = '(' + item_string + ')'
             contents_strings.append(item_string)
         return '#'.join(contents_strings)
     else:
-        return '{}({})'.format(ozify(label, **kwargs),
-                               ' '.join(ozify(c, **kwargs) for c in contents))
+        return '{}({})'.format(render(label, ctx), ' '.join(render(c, ctx) for c in contents))
 
-def ozify_record(label, contents, **kwargs):
-    entries = ['{}:{}'.format(ozify(k, **kwargs), ozify(v, **kwargs)) for k, v in contents]
-    return '{}({})'.format(label, ' '.join(entries))
+def ozify_record(r, ctx):
+    if r.items and type(r.items[0]) is not tuple:
+        # never normalized, its arity is unknown (see `disasm.py --stream`).
+        return '{}({})'.format(r.label, ' '.join(render(v, ctx) for v in r.items))
+    entries = ['{}:{}'.format(render(k, ctx), render(v, ctx)) for k, v in r.items]
+    return '{}({})'.format(r.label, ' '.join(entries))
 
-def ozify_abstraction(uuid, contents, **kwargs):
-    if not kwargs.get('is_verbose_abstraction', False):
-        return contents['codearea'][2]['name']
+def ozify_abstraction(r, ctx):
+    if not ctx.is_verbose_abstraction:
+        if type(r.codearea) is not oznodes.CodeArea:
+            # unresolved, see `disasm.py --stream`.
+            return str(r.codearea)
+        return r.codearea.name
     else:
-        return '<Abstraction {}/[{}]>'.format(ozify(contents['codearea'], **kwargs),
-                                              ' '.join(ozify(c, **kwargs) for c in contents['gs']))
-
-@singledispatch
-def ozify(r, **kwargs):
-    return str(r)
+        return '<Abstraction {}/[{}]>'.format(render(r.codearea, ctx),
+                                              ' '.join(render(c, ctx) for c in r.gs))
 
-@ozify.register(bool)
-def _(r, **kwargs):
-    return 'true' if r else 'false'
+RENDERERS = {
+    bool: lambda r, ctx: 'true' if r else 'false',
+    int: ozify_number,
+    float: ozify_number,
+    str: lambda r, ctx: ozify_atom(r),
+    oznodes.Unit: lambda r, ctx: 'unit',
+    oznodes.Cons: lambda r, ctx: '{}|{}'.format(render(r.head, ctx), render(r.tail, ctx)),
+    oznodes.Tuple: ozify_tuple,
+    oznodes.Arity: lambda r, ctx: '<Arity {}({})>'.format(
+        render(r.label, ctx), ' '.join(render(f, ctx) for f in r.features)),
+    oznodes.Record: ozify_record,
+    oznodes.PatMatOpenRecord: lambda r, ctx: ozify_record(r, ctx)[:-1] + ' ...)',
+    oznodes.PatMatConjunction: lambda r, ctx: '='.join(render(p, ctx) for p in r.parts),
+    oznodes.Builtin: lambda r, ctx: '{}.{}'.format(r.module, render(r.name, ctx)),
+    oznodes.PatMatWildcard: lambda r, ctx: '_',
+    oznodes.PatMatCapture: lambda r, ctx: '?X{}'.format(r.index),
+    oznodes.Reg: lambda r, ctx: '{}{}'.format(r.regclass, r.num),
+    oznodes.Abstraction: ozify_abstraction,
+    oznodes.CodeArea: lambda r, ctx: "<CodeArea '{}'/{}>".format(r.name, r.arity),
+    oznodes.UniqueName: lambda r, ctx: '<UniqueName {}>'.format(r.name),
+    oznodes.Name: lambda r, ctx: '<Name {}>'.format(oznodes.format_uuid(r.uuid)),
+    oznodes.NamedName: lambda r, ctx: '<Name {}>'.format(r.name),
+    oznodes.Chunk: lambda r, ctx: '<Chunk {}>'.format(render(r.value, ctx)),
+    oznodes.UnicodeString: lambda r, ctx: '"' + STRING_ESCAPE.sub(r'\\\1', r.value) + '"',
+}
 
-@ozify.register(int)
-@ozify.register(float)
-def _(r, **kwargs):
-    return str(r).replace('-', '~')
+# nodes which may be part of a cycle, only rendered once per ozify() call.
+TRACKED_TYPES = set(cls for cls in RENDERERS if getattr(cls, 'ref_fields', ()))
 
-@ozify.register(str)
-def _(r, **kwargs):
-    if not re.match('^[a-z][a-z0-9A-Z_]*$', r) or r in KEYWORDS:
-        return "'" + re.sub(r"(['\\])", r"\\\1", r) + "'"
-    else:
-        return r
+def find_renderer(cls):
+    # subclasses render as their nearest known base class.
+    for base in cls.__mro__:
+        if base in RENDERERS:
+            if base in TRACKED_TYPES:
+                TRACKED_TYPES.add(cls)
+            return RENDERERS.setdefault(cls, RENDERERS[base])
+    return None
 
-@ozify.register(list)
-def _(r, **kwargs):
-    visited = kwargs.get('visited', set())
-    if id(r) in visited:
-        return '...'
-    visited.add(id(r))
-    kwargs['visited'] = visited
-
-    return {
-        'unit': lambda: 'unit',
-        'cons': lambda x, y: '{}|{}'.format(ozify(x, **kwargs), ozify(y, **kwargs)),
-        'tuple': lambda l, c: ozify_tuple(l, c, **kwargs),
-        'record': lambda l, c: ozify_record(l, c, **kwargs),
-        'builtin': lambda m, b: '{}.{}'.format(m, ozify(b, **kwargs)),
-        'patmatwildcard': lambda: '_',
-        'patmatcapture': lambda c: '?X{}'.format(c),
-        'reg': lambda rc, n: '{}{}'.format(rc, n),
-        'abstraction': lambda uuid, c: ozify_abstraction(uuid, c, **kwargs),
-        'codearea': lambda uuid, d: "<CodeArea '{}'/{}>".format(d['name'], d['arity']),
-        'uniquename': lambda c: '<UniqueName {}>'.format(c),
-    }[r[0]](*r[1:])
+def render(r, ctx):
+    cls = type(r)
+    renderer = RENDERERS.get(cls) or find_renderer(cls)
+    if renderer is None:
+        return str(r)
+    if cls in TRACKED_TYPES:
+        if id(r) in ctx.visited:
+            return '...'
+        ctx.visited.add(id(r))
+    return renderer(r, ctx)
 
+def ozify(r, is_verbose_abstraction=False):
+    return render(r, Context(is_verbose_abstraction))
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+# Typed nodes of an unpickled Oz value graph. Ints, floats, bools and atoms
+# are represented by the plain Python int, float, bool and str.
+
+from reprlib import recursive_repr
+
+def format_uuid(raw):
+    # UUIDs are kept as their 16 raw bytes and only formatted when printed,
+    # as str(uuid.UUID(bytes=raw)) would.
+    h = raw.hex()
+    return '{}-{}-{}-{}-{}'.format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+def legacy_uuid(raw):
+    # older versions produced uuid.UUID objects.
+    import uuid
+    return uuid.UUID(bytes=raw) if raw is not None else None
+
+class Node:
+    __slots__ = fields = ()
+    tag = None
+
+    # fields which may refer to other nodes, followed by the resolver.
+    ref_fields = ()
+    # those through which a codearea may be reached.
+    code_fields = ()
+
+    @recursive_repr()
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join(repr(getattr(self, f)) for f in self.fields))
+
+    def legacy_fields(self):
+        return [legacy_uuid(getattr(self, f)) if f == 'uuid' else getattr(self, f)
+                for f in self.fields]
+
+class Unit(Node):
+    __slots__ = fields = ()
+    tag = 'unit'
+
+class Cons(Node):
+    __slots__ = fields = ('head', 'tail')
+    tag = 'cons'
+    ref_fields = code_fields = fields
+
+    def __init__(self, head, tail):
+        self.head = head
+        self.tail = tail
+
+class Tuple(Node):
+    __slots__ = fields = ('label', 'contents')
+    tag = 'tuple'
+    ref_fields = fields
+    code_fields = ('contents',)
+
+    def __init__(self, label, contents):
+        self.label = label
+        self.contents = contents
+
+class Arity(Node):
+    __slots__ = fields = ('label', 'features')
+    tag = 'arity'
+    ref_fields = fields
+
+    def __init__(self, label, features):
+        self.label = label
+        self.features = features
+
+class Record(Node):
+    __slots__ = fields = ('label', 'items')
+    tag = 'record'
+    ref_fields = fields
+    code_fields = ('items',)
+
+    def __init__(self, label, items):
+        self.label = label
+        self.items = items
+
+    def normalize(self):
+        # a record is read as (arity, values); turn it into (label, [(feature, value)]).
+        arity = self.label
+        if type(arity) is Arity:
+            self.label = arity.label
+            self.items = list(zip(arity.features, self.items))
+
+class Builtin(Node):
+    __slots__ = fields = ('module', 'name')
+    tag = 'builtin'
+
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+class CodeArea(Node):
+    __slots__ = fields = ('uuid', 'code', 'arity', 'xcount', 'name', 'debug_data', 'ks')
+    tag = 'codearea'
+    ref_fields = ('debug_data', 'ks')
+    code_fields = ('ks',)
+
+    def __init__(self, uuid, code, arity, xcount, name, debug_data, ks):
+        self.uuid = uuid
+        self.code = code
+        self.arity = arity
+        self.xcount = xcount
+        self.name = name
+        self.debug_data = debug_data
+        self.ks = ks
+
+    def legacy_fields(self):
+        return [legacy_uuid(self.uuid), {
+            'code': bytes(self.code),
+            'arity': self.arity,
+            'xcount': self.xcount,
+            'name': self.name,
+            'debug_data': self.debug_data,
+            'ks': self.ks,
+        }]
+
+class PatMatWildcard(Node):
+    __slots__ = fields = ()
+    tag = 'patmatwildcard'
+
+class PatMatCapture(Node):
+    __slots__ = fields = ('index',)
+    tag = 'patmatcapture'
+
+    def __init__(self, index):
+        self.index = index
+
+class PatMatConjunction(Node):
+    __slots__ = fields = ('parts',)
+    tag = 'patmatconjunction'
+    ref_fields = fields
+
+    def __init__(self, parts):
+        self.parts = parts
+
+class PatMatOpenRecord(Record):
+    __slots__ = ()
+    tag = 'patmatopenrecord'
+    code_fields = ()
+
+class Abstraction(Node):
+    __slots__ = fields = ('uuid', 'codearea', 'gs')
+    tag = 'abstraction'
+    ref_fields = code_fields = ('codearea', 'gs')
+
+    def __init__(self, uuid, codearea, gs):
+        self.uuid = uuid
+        self.codearea = codearea
+        self.gs = gs
+
+    def legacy_fields(self):
+        return [legacy_uuid(self.uuid), {
+            'codearea': self.codearea,
+            'gs': self.gs,
+        }]
+
+class Chunk(Node):
+    __slots__ = fields = ('value',)
+    tag = 'chunk'
+    ref_fields = code_fields = fields
+
+    def __init__(self, value):
+        self.value = value
+
+class UniqueName(Node):
+    __slots__ = fields = ('name',)
+    tag = 'uniquename'
+
+    def __init__(self, name):
+        self.name = name
+
+class Name(Node):
+    __slots__ = fields = ('uuid',)
+    tag = 'name'
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+class NamedName(Node):
+    __slots__ = fields = ('uuid', 'name')
+    tag = 'namedname'
+
+    def __init__(self, uuid, name):
+        self.uuid = uuid
+        self.name = name
+
+class UnicodeString(Node):
+    __slots__ = fields = ('value',)
+    tag = 'unicodeString'
+
+    def __init__(self, value):
+        self.value = value
+
+class Reg(Node):
+    __slots__ = fields = ('regclass', 'num')
+    tag = 'reg'
+
+    def __init__(self, regclass, num):
+        self.regclass = regclass
+        self.num = num
+
+
+UNIT = Unit()
+WILDCARD = PatMatWildcard()
+
+# classes whose instances may hold references, i.e. what the resolver walks.
+CONTAINER_TYPES = frozenset([list, Cons, Tuple, Arity, Record, CodeArea, PatMatConjunction,
+                             PatMatOpenRecord, Abstraction, Chunk])
+
+
+def to_legacy(value):
+    # Converts a node graph to the tagged-list form used by older versions,
+    # e.g. ['cons', 1, ['cons', 2, 'nil']] or ['codearea', uuid, {...}].
+    memo = {}
+    pending = []
+
+    def convert(v):
+        if isinstance(v, (Node, list)):
+            if id(v) in memo:
+                return memo[id(v)]
+            retval = memo[id(v)] = []
+            pending.append((v, retval))
+            return retval
+        elif isinstance(v, tuple):
+            return tuple(map(convert, v))
+        else:
+            return v
+
+    root = convert(value)
+    while pending:
+        (v, retval) = pending.pop()
+        if isinstance(v, Node):
+            retval.append(v.tag)
+            for field in v.legacy_fields():
+                if isinstance(field, dict):
+                    # the codearea and abstraction payloads
+                    field = {k: convert(x) for k, x in field.items()}
+                else:
+                    field = convert(field)
+                retval.append(field)
+        else:
+            retval.extend(map(convert, v))
+    return root
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
-import uuid
-import re
-try:
-    from functools import singledispatch
-except ImportError:
-    from singledispatch import singledispatch
+import array
+import collections
+import io
+import mmap
+import os
+import struct
+import sys
+from oznodes import (Node, UNIT, WILDCARD, CONTAINER_TYPES, Cons, Tuple, Arity, Record, Builtin,
+                     CodeArea, PatMatCapture, PatMatConjunction, PatMatOpenRecord,
+                     Abstraction, Chunk, UniqueName, Name, NamedName, UnicodeString,
+                     to_legacy)
 
 TYPE_IDS = [
     'int', #1
@@ -31,6 +36,36 @@ TYPE_IDS = [
     'unicodeString', #21
 ]
 
+# Field layout of every node type, used to skip over nodes without parsing:
+#  r = reference, i = int, u = uuid, b = byte,
+#  s = string, l = reference list, c = code (length-prefixed).
+NODE_LAYOUTS = [
+    's', #int
+    's', #float
+    'b', #bool
+    '', #unit
+    's', #atom
+    'rr', #cons
+    'rl', #tuple
+    'rl', #arity
+    'rl', #record
+    'ss', #builtin
+    'uciisrl', #codearea
+    '', #patmatwildcard
+    'i', #patmatcapture
+    'l', #patmatconjunction
+    'rl', #patmatopenrecord
+    'url', #abstraction
+    'r', #chunk
+    's', #uniquename
+    'u', #name
+    'us', #namedname
+    's', #unicodeString
+]
+
+FIXED_FIELD_SIZES = {'r': 4, 'i': 4, 'u': 16, 'b': 1}
+PREFIXED_FIELD_SIZES = {'s': 1, 'l': 4, 'c': 2}
+
 class Cell:
     def __init__(self, index):
         self.index = index
@@ -38,52 +73,113 @@ class Cell:
     def __repr__(self):
         return 'Cell({})'.format(self.index)
 
-@singledispatch
-def resolve(node, nodes_list, resolved_objects):
-    return node
-
-@resolve.register(Cell)
-def _(cell, nodes_list, resolved_objects):
-    retval = resolve(nodes_list[cell.index], nodes_list, resolved_objects)
-    nodes_list[cell.index] = retval
-    return retval
-
-def normalize_record(lst):
-    if lst[0].endswith('/prenormalized'):
-        lst[0] = lst[0][:-14]
-        lst[2] = list(zip(lst[1][2], lst[2]))
-        lst[1] = lst[1][1]
-    elif lst[0] == '*':
-        lst[:] = lst[1:]
-
+    def __str__(self):
+        return '<Node {}>'.format(self.index)
+
+def deref(value, nodes_list):
+    if type(value) is not Cell:
+        return value
+    chain = []
+    while type(value) is Cell:
+        if value.index in chain:
+            raise ValueError('Node {} is never defined'.format(value.index))
+        chain.append(value.index)
+        value = nodes_list[value.index]
+    # collapse the chain so later references resolve in one step.
+    for index in chain:
+        nodes_list[index] = value
+    return value
 
-@resolve.register(list)
-def _(lst, nodes_list, resolved_objects):
-    if id(lst) in resolved_objects:
-        return lst
-    resolved_objects.add(id(lst))
-
-    for i, item in enumerate(lst):
-        lst[i] = resolve(item, nodes_list, resolved_objects)
-
-    normalize_record(lst)
-    return lst
+def resolve(node, nodes_list, resolved_objects):
+    node = deref(node, nodes_list)
+    if type(node) not in CONTAINER_TYPES or id(node) in resolved_objects:
+        return node
+    resolved_objects.add(id(node))
+
+    # Walk the graph with an explicit worklist, replacing every Cell by the
+    # node it refers to. Records can only be normalized once their arity is
+    # resolved, so they are collected and normalized at the end.
+    pending = [node]
+    records = []
+    while pending:
+        container = pending.pop()
+        if type(container) is list:
+            for i, item in enumerate(container):
+                if type(item) is Cell:
+                    item = container[i] = deref(item, nodes_list)
+                if type(item) in CONTAINER_TYPES and id(item) not in resolved_objects:
+                    resolved_objects.add(id(item))
+                    pending.append(item)
+        else:
+            if isinstance(container, Record):
+                records.append(container)
+            for field in container.ref_fields:
+                item = getattr(container, field)
+                if type(item) is Cell:
+                    item = deref(item, nodes_list)
+                    setattr(container, field, item)
+                if type(item) in CONTAINER_TYPES and id(item) not in resolved_objects:
+                    resolved_objects.add(id(item))
+                    pending.append(item)
+
+    for record in records:
+        # the values list is replaced, its id may be reused by a later node.
+        resolved_objects.discard(id(record.items))
+        record.normalize()
 
-@resolve.register(dict)
-def _(dct, nodes_list, resolved_objects):
-    if id(dct) in resolved_objects:
-        return dct
-    resolved_objects.add(id(dct))
+    return node
 
-    for key in dct:
-        dct[key] = resolve(dct[key], nodes_list, resolved_objects)
 
-    return dct
+def code_flags(nodes):
+    # flags[i] is set when node i is a codearea, an abstraction or leads to
+    # one through code_fields, found by walking the references backwards
+    # from them. Works on the nodes as read, before resolve().
+    parents = collections.defaultdict(list)
+    pending = []
+    for i, node in enumerate(nodes):
+        t = type(node)
+        if t is Cell:
+            # not defined here, or an alias.
+            parents[node.index].append(i)
+            continue
+        elif not isinstance(node, Node) or not t.code_fields:
+            continue
+        elif t is CodeArea or t is Abstraction:
+            pending.append(i)
+        for field in t.code_fields:
+            value = getattr(node, field)
+            for ref in value if type(value) is list else (value,):
+                if type(ref) is Cell:
+                    parents[ref.index].append(i)
+    flags = bytearray(len(nodes))
+    for i in pending:
+        flags[i] = 1
+    while pending:
+        for parent in parents.get(pending.pop(), ()):
+            if not flags[parent]:
+                flags[parent] = 1
+                pending.append(parent)
+    return flags
+
+
+class _NoTable(dict):
+    # stands in for the sharing tables when nothing may be kept.
+    def __setitem__(self, key, value):
+        pass
 
 
 class Unpickler:
-    def __init__(self, fileobj):
+    def __init__(self, fileobj, share=True):
         self.fileobj = fileobj
+        # Per-load tables sharing equal strings, builtins and arities. For
+        # each kind, `saved` counts the duplicates and `saved_bytes` the
+        # memory they would have taken.
+        table = dict if share else _NoTable
+        self.strings = table()
+        self.builtins = table()
+        self.arities = table()
+        self.saved = collections.Counter()
+        self.saved_bytes = 0
 
     def read(self, n):
         return self.fileobj.read(n)
@@ -92,8 +188,18 @@ class Unpickler:
         return int.from_bytes(self.read(4), 'big')
 
     def read_str(self):
-        length = self.read_int()
-        return self.read(length).decode()
+        key = bytes(self.read(self.read_int()))
+        value = self.strings.get(key)
+        if value is None:
+            value = self.strings[key] = str(key, 'utf-8')
+        else:
+            self.saved['string'] += 1
+            self.saved_bytes += sys.getsizeof(value)
+        return value
+
+    def read_number_str(self):
+        # numbers are not interned, they are converted right away.
+        return str(self.read(self.read_int()), 'utf-8')
 
     def read_ref(self):
         index = self.read_int() - 1
@@ -101,25 +207,23 @@ class Unpickler:
 
     def read_ref_list(self):
         count = self.read_int()
-        retval = ['*']
-        for _ in range(count):
-            retval.append(self.read_ref())
-        return retval
+        return [self.read_ref() for _ in range(count)]
 
     def read_uuid(self):
-        return uuid.UUID(bytes=self.read(16))
+        # kept as raw bytes, see oznodes.format_uuid().
+        return bytes(self.read(16))
 
     def read_oz_int(self):
-        return int(self.read_str().replace('~', '-'))
+        return int(self.read_number_str().replace('~', '-'))
 
     def read_oz_float(self):
-        return float(self.read_str().replace('~', '-'))
+        return float(self.read_number_str().replace('~', '-'))
 
     def read_oz_bool(self):
-        return bool(self.read(1))
+        return self.read(1)[0] != 0
 
     def read_oz_unit(self):
-        return ['unit']
+        return UNIT
 
     def read_oz_atom(self):
         return self.read_str()
@@ -127,26 +231,40 @@ class Unpickler:
     def read_oz_cons(self):
         head = self.read_ref()
         tail = self.read_ref()
-        return ['cons', head, tail]
+        return Cons(head, tail)
 
     def read_oz_tuple(self):
         label = self.read_ref()
         contents = self.read_ref_list()
-        return ['tuple', label, contents]
+        return Tuple(label, contents)
 
     def read_oz_arity(self):
-        as_tuple = self.read_oz_tuple()
-        return ['arity', as_tuple[1], as_tuple[2]]
+        label = self.read_ref()
+        features = self.read_ref_list()
+        key = (label.index,) + tuple(f.index for f in features)
+        arity = self.arities.get(key)
+        if arity is None:
+            arity = self.arities[key] = Arity(label, features)
+        else:
+            self.saved['arity'] += 1
+            self.saved_bytes += sys.getsizeof(arity) + sys.getsizeof(features)
+        return arity
 
     def read_oz_record(self):
         arity = self.read_ref()
         contents = self.read_ref_list()
-        return ['record/prenormalized', arity, contents]
+        # normalized by resolve() once the arity is known.
+        return Record(arity, contents)
 
     def read_oz_builtin(self):
-        module = self.read_str()
-        builtin = self.read_str()
-        return ['builtin', module, builtin]
+        key = (self.read_str(), self.read_str())
+        builtin = self.builtins.get(key)
+        if builtin is None:
+            builtin = self.builtins[key] = Builtin(*key)
+        else:
+            self.saved['builtin'] += 1
+            self.saved_bytes += sys.getsizeof(builtin)
+        return builtin
 
     def read_oz_codearea(self):
         uuid = self.read_uuid()
@@ -157,78 +275,449 @@ class Unpickler:
         name = self.read_str()
         debug_data = self.read_ref()
         ks = self.read_ref_list()
-        return ['codearea', uuid, {
-            'code': code,
-            'arity': arity,
-            'xcount': xcount,
-            'name': name,
-            'debug_data': debug_data,
-            'ks': ks,
-        }]
+        return CodeArea(uuid, code, arity, xcount, name, debug_data, ks)
 
     def read_oz_patmatwildcard(self):
-        return ['patmatwildcard']
+        return WILDCARD
 
     def read_oz_patmatcapture(self):
-        return ['patmatcapture', self.read_int()]
+        return PatMatCapture(self.read_int())
 
     def read_oz_patmatconjunction(self):
-        return ['patmatconjunction', self.read_ref_list()]
+        return PatMatConjunction(self.read_ref_list())
 
     def read_oz_patmatopenrecord(self):
-        as_record = self.read_oz_record()
-        return ['patmatopenrecord/prenormalized', as_record[1], as_record[2]]
+        arity = self.read_ref()
+        contents = self.read_ref_list()
+        return PatMatOpenRecord(arity, contents)
 
     def read_oz_abstraction(self):
         uuid = self.read_uuid()
         codearea = self.read_ref()
         gs = self.read_ref_list()
-        return ['abstraction', uuid, {
-            'codearea': codearea,
-            'gs': gs
-        }]
+        return Abstraction(uuid, codearea, gs)
 
     def read_oz_chunk(self):
-        return ['chunk', self.read_ref()]
+        return Chunk(self.read_ref())
 
     def read_oz_uniquename(self):
-        return ['uniquename', self.read_str()]
+        return UniqueName(self.read_str())
 
     def read_oz_name(self):
-        return ['name', self.read_uuid()]
+        return Name(self.read_uuid())
 
     def read_oz_namedname(self):
         uuid = self.read_uuid()
         name = self.read_str()
-        return ['namedname', uuid, name]
+        return NamedName(uuid, name)
 
     def read_oz_unicodeString(self):
-        return ['unicodeString', self.read_str()]
+        return UnicodeString(self.read_str())
 
-    def unpickle(self):
+    def read_node_header(self):
+        index = self.read_int() - 1
+        if index < 0:
+            return (index, None)
+        return (index, self.read(1)[0] - 1)
+
+    def remaining(self):
+        # the bytes left to read, or None if unknown (e.g. a pipe).
+        try:
+            return os.fstat(self.fileobj.fileno()).st_size - self.fileobj.tell()
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            return None
+
+    def read_nodes_count(self):
+        # checked against the input size before anything is allocated for
+        # the nodes, a corrupt header could otherwise exhaust the memory.
         nodes_count = self.read_int()
-        unresolved_nodes = set(range(nodes_count))
+        remaining = self.remaining()
+        if remaining is not None and nodes_count > remaining // MIN_NODE_SIZE:
+            raise ValueError('Corrupt header: {} nodes in {} bytes'.format(nodes_count, remaining))
+        return nodes_count
+
+    def read_nodes(self):
+        # (nodes, result_index), the nodes still referring to each other by Cell.
+        readers = [getattr(self, 'read_oz_' + type_name) for type_name in TYPE_IDS]
+        nodes_count = self.read_nodes_count()
         nodes = [Cell(i) for i in range(nodes_count)]
         result_index = self.read_int() - 1
         while True:
-            index = self.read_int() - 1
+            (index, type_id) = self.read_node_header()
             if index < 0:
                 break
-            type_id = self.read(1)[0] - 1
-            nodes[index] = getattr(self, 'read_oz_' + TYPE_IDS[type_id])()
+            nodes[index] = readers[type_id]()
+        return (nodes, result_index)
+
+    def events(self):
+        # Yields (index, type name, node) for every node in file order,
+        # references left as Cells. Nothing is kept between events, so
+        # memory does not grow with the file; `nodes_count` and
+        # `result_index` are set once the first event is produced.
+        readers = [getattr(self, 'read_oz_' + type_name) for type_name in TYPE_IDS]
+        self.nodes_count = self.read_int()
+        self.result_index = self.read_int() - 1
+        while True:
+            (index, type_id) = self.read_node_header()
+            if index < 0:
+                return
+            yield (index, TYPE_IDS[type_id], readers[type_id]())
 
+    def unpickle(self):
+        (nodes, result_index) = self.read_nodes()
         return resolve(nodes[result_index], nodes, set())
 
 
-def load(fileobj):
-    return Unpickler(fileobj).unpickle()
+_UINT32 = struct.Struct('>I')
+# a node header (index and type) without any field.
+MIN_NODE_SIZE = 5
+_NODE_HEADER = struct.Struct('>IB')
+
+class BufferUnpickler(Unpickler):
+    def __init__(self, buf, pos=0, share=True):
+        Unpickler.__init__(self, None, share)
+        self.buf = memoryview(buf).cast('B')
+        self.pos = pos
+
+    def read(self, n):
+        pos = self.pos
+        self.pos = pos + n
+        return self.buf[pos:pos+n]
+
+    def remaining(self):
+        return len(self.buf) - self.pos
+
+    def read_int(self):
+        try:
+            (value,) = _UINT32.unpack_from(self.buf, self.pos)
+        except struct.error:
+            # truncated input, behave like a short read from a stream.
+            return int.from_bytes(self.read(4), 'big')
+        self.pos += 4
+        return value
+
+    def read_ref(self):
+        return Cell(self.read_int() - 1)
+
+    def read_ref_list(self):
+        count = self.read_int()
+        pos = self.pos
+        self.pos = pos + 4*count
+        return [Cell(i - 1) for i in struct.unpack_from('>{}I'.format(count), self.buf, pos)]
+
+    def read_node_header(self):
+        try:
+            (index, type_id) = _NODE_HEADER.unpack_from(self.buf, self.pos)
+        except struct.error:
+            return Unpickler.read_node_header(self)
+        if index == 0:
+            return Unpickler.read_node_header(self)
+        self.pos += 5
+        return (index - 1, type_id - 1)
+
+
+    def read_codearea_info(self, index):
+        # the header fields of a codearea, skipping its code and constants.
+        uuid = self.read_uuid()
+        code_size = self.read_int()
+        self.pos += code_size*2
+        arity = self.read_int()
+        xcount = self.read_int()
+        name = self.read_str()
+        return CodeAreaInfo(index, uuid, name, arity, xcount, code_size)
+
+    def skip_node(self, layout):
+        pos = self.pos
+        for field in layout:
+            if field in FIXED_FIELD_SIZES:
+                pos += FIXED_FIELD_SIZES[field]
+            else:
+                (length,) = _UINT32.unpack_from(self.buf, pos)
+                pos += 4 + length * PREFIXED_FIELD_SIZES[field]
+        self.pos = pos
+
+    def scan(self):
+        nodes_count = self.read_nodes_count()
+        result_index = self.read_int() - 1
+        offsets = array.array('q', [-1]) * nodes_count
+        type_ids = bytearray(b'\xff') * nodes_count
+        while True:
+            (index, type_id) = self.read_node_header()
+            if index < 0:
+                break
+            offsets[index] = self.pos
+            type_ids[index] = type_id
+            self.skip_node(NODE_LAYOUTS[type_id])
+
+        return NodeTable(self, result_index, offsets, type_ids)
+
+
+class NodeTable:
+    def __init__(self, unpickler, result_index, offsets, type_ids):
+        self.unpickler = unpickler
+        self.result_index = result_index
+        self.offsets = offsets
+        self.type_ids = type_ids
+        self.readers = [getattr(unpickler, 'read_oz_' + type_name) for type_name in TYPE_IDS]
+        self.nodes = [None] * len(offsets)
+        self.resolved_objects = set()
+        self.codeareas = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __getitem__(self, index):
+        node = self.nodes[index]
+        if node is None:
+            offset = self.offsets[index]
+            if offset < 0:
+                node = Cell(index)
+            else:
+                self.unpickler.pos = offset
+                node = self.readers[self.type_ids[index]]()
+            self.nodes[index] = node
+        return node
+
+    def __setitem__(self, index, value):
+        self.nodes[index] = value
+
+    def type_names(self):
+        # the type of every node, without parsing them.
+        return [TYPE_IDS[t] for t in self.type_ids if t != 0xff]
+
+    def indexes(self, type_name):
+        type_id = TYPE_IDS.index(type_name)
+        return [i for i, t in enumerate(self.type_ids) if t == type_id]
+
+    def resolve(self, index):
+        return resolve(self[index], self, self.resolved_objects)
+
+    def codearea_index(self):
+        # built on first use, without parsing the codeareas themselves.
+        if self.codeareas is None:
+            infos = []
+            for index in self.indexes('codearea'):
+                self.unpickler.pos = self.offsets[index]
+                infos.append(self.unpickler.read_codearea_info(index))
+            self.codeareas = CodeAreaIndex(infos)
+        return self.codeareas
+
+    def root(self):
+        return self.resolve(self.result_index)
+
+
+CodeAreaInfo = collections.namedtuple('CodeAreaInfo',
+                                      ['index', 'uuid', 'name', 'arity', 'xcount', 'size'])
+
+class CodeAreaIndex:
+    # The codeareas of a file by node index, name and UUID.
+    def __init__(self, infos):
+        self.infos = infos
+        self.by_name = collections.defaultdict(list)
+        self.by_uuid = {}
+        for info in infos:
+            self.by_name[info.name].append(info)
+            self.by_uuid[info.uuid] = info
+
+    def __len__(self):
+        return len(self.infos)
+
+    def __iter__(self):
+        return iter(self.infos)
+
+
+SCALAR_TYPE_NAMES = {bool: 'bool', int: 'int', float: 'float', str: 'atom'}
+
+def type_name(value):
+    # the TYPE_IDS name of an unpickled value.
+    return SCALAR_TYPE_NAMES.get(type(value)) or value.tag
+
+NIL_UUID = bytes(16)
+
+class Pickler:
+    # The inverse of Unpickler: writes a value graph as an *.ozf stream.
+    # Nodes and lists are shared by identity and scalars by value; the
+    # graph is walked with a worklist, so long chains are fine.
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def dump(self, value):
+        self.indexes = {}
+        self.pending = []
+        self.out = []
+        # nodes created while writing, kept alive so that their ids stay unique.
+        self.temporaries = []
+        root = self.ref(value)
+        while self.pending:
+            (index, value) = self.pending.pop()
+            self.write_node(index, value)
+        self.fileobj.write(_UINT32.pack(len(self.indexes)) + _UINT32.pack(root + 1))
+        self.fileobj.write(b''.join(self.out))
+        self.fileobj.write(_UINT32.pack(0))
+
+    def ref(self, value):
+        t = type(value)
+        key = (t, value) if t in (bool, int, float, str) else id(value)
+        index = self.indexes.get(key)
+        if index is None:
+            index = self.indexes[key] = len(self.indexes)
+            self.pending.append((index, value))
+        return index
+
+    def write_int(self, value):
+        self.out.append(_UINT32.pack(value))
+
+    def write_str(self, value):
+        data = value.encode('utf-8', 'surrogatepass')
+        self.out.append(_UINT32.pack(len(data)) + data)
+
+    def write_ref(self, value):
+        self.write_int(self.ref(value) + 1)
+
+    def write_ref_list(self, values):
+        self.out.append(struct.pack('>{}I'.format(len(values) + 1), len(values),
+                                    *[self.ref(v) + 1 for v in values]))
+
+    def write_uuid(self, value):
+        self.out.append(bytes(value or NIL_UUID))
+
+    def write_node(self, index, value):
+        name = type_name(value)
+        self.out.append(_NODE_HEADER.pack(index + 1, TYPE_IDS.index(name) + 1))
+        getattr(self, 'write_oz_' + name)(value)
+
+    def write_oz_bool(self, value):
+        self.out.append(b'\x01' if value else b'\x00')
+
+    def write_oz_int(self, value):
+        self.write_str(str(value).replace('-', '~'))
+
+    def write_oz_float(self, value):
+        self.write_str(repr(value).replace('-', '~'))
+
+    def write_oz_atom(self, value):
+        self.write_str(value)
+
+    def write_oz_unit(self, value):
+        pass
+
+    write_oz_patmatwildcard = write_oz_unit
+
+    def write_oz_cons(self, value):
+        self.write_ref(value.head)
+        self.write_ref(value.tail)
+
+    def write_oz_tuple(self, value):
+        self.write_ref(value.label)
+        self.write_ref_list(value.contents)
+
+    def write_oz_arity(self, value):
+        self.write_ref(value.label)
+        self.write_ref_list(value.features)
+
+    def write_oz_record(self, value):
+        if type(value.label) is Arity:
+            (arity, values) = (value.label, value.items)
+        else:
+            # a normalized record, (label, [(feature, value)]).
+            arity = Arity(value.label, [f for f, _ in value.items])
+            values = [v for _, v in value.items]
+            self.temporaries.append(arity)
+        self.write_ref(arity)
+        self.write_ref_list(values)
+
+    write_oz_patmatopenrecord = write_oz_record
+
+    def write_oz_builtin(self, value):
+        self.write_str(value.module)
+        self.write_str(value.name)
+
+    def write_oz_codearea(self, value):
+        self.write_uuid(value.uuid)
+        self.write_int(len(value.code) // 2)
+        self.out.append(bytes(value.code))
+        self.write_int(value.arity)
+        self.write_int(value.xcount)
+        self.write_str(value.name)
+        self.write_ref(UNIT if value.debug_data is None else value.debug_data)
+        self.write_ref_list(value.ks)
+
+    def write_oz_patmatcapture(self, value):
+        self.write_int(value.index)
+
+    def write_oz_patmatconjunction(self, value):
+        self.write_ref_list(value.parts)
+
+    def write_oz_abstraction(self, value):
+        self.write_uuid(value.uuid)
+        self.write_ref(value.codearea)
+        self.write_ref_list(value.gs)
+
+    def write_oz_chunk(self, value):
+        self.write_ref(value.value)
+
+    def write_oz_uniquename(self, value):
+        self.write_str(value.name)
+
+    def write_oz_name(self, value):
+        self.write_uuid(value.uuid)
+
+    def write_oz_namedname(self, value):
+        self.write_uuid(value.uuid)
+        self.write_str(value.name)
+
+    def write_oz_unicodeString(self, value):
+        self.write_str(value.value)
+
+
+def dumps(value):
+    out = io.BytesIO()
+    Pickler(out).dump(value)
+    return out.getvalue()
+
+def dump(value, fileobj):
+    Pickler(fileobj).dump(value)
+
+
+def map_file(fileobj):
+    try:
+        fileno = fileobj.fileno()
+        offset = fileobj.tell()
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ), offset
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        # pipes, sockets, empty or in-memory files.
+        return None, 0
+
+
+def loads(buf, lazy=False):
+    unpickler = BufferUnpickler(buf)
+    return unpickler.scan() if lazy else unpickler.unpickle()
+
+
+def load(fileobj, lazy=False):
+    buf, offset = map_file(fileobj)
+    if buf is None:
+        if not lazy:
+            return Unpickler(fileobj).unpickle()
+        (buf, offset) = (fileobj.read(), 0)
+    unpickler = BufferUnpickler(buf, offset)
+    return unpickler.scan() if lazy else unpickler.unpickle()
+
+
+def iter_events(fileobj):
+    # Unpickler.events() of a file, mapped when possible (the mapped pages
+    # are not the process' own memory) or else read sequentially, e.g. a pipe.
+    (buf, offset) = map_file(fileobj)
+    if buf is None:
+        return Unpickler(fileobj, share=False).events()
+    return BufferUnpickler(buf, offset, share=False).events()
 
 
 if __name__ == '__main__':
     import pprint
-    import sys
     with open(sys.argv[1], 'rb') as f:
-        pprint.pprint(load(f))
+        pprint.pprint(to_legacy(load(f)))
 
 
 
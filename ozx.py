@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# Compact binary export of the decoded procedures of an *.ozf file (*.ozx),
+# for tools which would otherwise parse the output of disasm.py back. Every
+# table is a flat little-endian array, so a loaded file is only mapped and
+# sliced, never parsed:
+#
+#   header      magic, version and the (offset, count) of each section
+#   strings     count + 1 offsets (uint32) into the UTF-8 blob that follows
+#   codeareas   one CODEAREA record per procedure, in file order
+#   ktypes      TYPE_IDS index of each constant (uint8, 0xff if unknown)
+#   ktexts      string index of each constant, see xref.constant_key (uint32)
+#   pcs, opcodes   the start and opcode of each instruction (uint32, uint16)
+#   words       the code as 16-bit words, the operands following each opcode
+#               up to the next pc
+
+import argparse
+import array
+import struct
+import sys
+import ozpickle
+import opcodes
+import xref
+from oznodes import format_uuid
+
+MAGIC = b'OZX\0'
+OZX_VERSION = 1
+
+SECTIONS = ['string_offsets', 'string_blob', 'codeareas', 'ktypes', 'ktexts',
+            'pcs', 'opcodes', 'words']
+TYPECODES = {'string_offsets': 'I', 'string_blob': 'B', 'ktypes': 'B', 'ktexts': 'I',
+             'pcs': 'I', 'opcodes': 'H', 'words': 'H'}
+
+HEADER = struct.Struct('<4sI' + 'QQ' * len(SECTIONS))
+# uuid, name, arity, xcount, then (start, count) of its constants,
+# instructions and words.
+CODEAREA = struct.Struct('<16sIIIIIIIII')
+
+def little_endian(arr):
+    if sys.byteorder == 'big' and arr.itemsize > 1:
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return arr
+
+
+class Writer:
+    def __init__(self):
+        self.strings = {}
+        self.tables = {name: array.array(TYPECODES.get(name, 'B')) for name in SECTIONS}
+        self.tables['string_offsets'].append(0)
+        self.count = 0
+        # the keys of the constants already seen, see xref.constant_key.
+        self.keys = {}
+
+    def string(self, text):
+        index = self.strings.get(text)
+        if index is None:
+            index = self.strings[text] = len(self.strings)
+            self.tables['string_blob'].frombytes(text.encode('utf-8', 'surrogatepass'))
+            self.tables['string_offsets'].append(len(self.tables['string_blob']))
+        return index
+
+    def add(self, ca):
+        t = self.tables
+        stream = opcodes.InstructionStream(ca.code, ca.ks)
+        record = CODEAREA.pack(ca.uuid or bytes(16),
+                               self.string(ca.name or ''), ca.arity, ca.xcount,
+                               len(t['ktexts']), len(ca.ks),
+                               len(t['pcs']), len(stream),
+                               len(t['words']), len(stream.words))
+        t['codeareas'].frombytes(record)
+        for k in ca.ks:
+            name = ozpickle.type_name(k) if type(k) is not ozpickle.Cell else None
+            t['ktypes'].append(ozpickle.TYPE_IDS.index(name) if name in ozpickle.TYPE_IDS else 0xff)
+            t['ktexts'].append(self.string(xref.constant_key(k, self.keys)))
+        t['pcs'].extend(stream.pcs)
+        t['opcodes'].extend(stream.opcodes)
+        t['words'].extend(stream.words)
+        self.count += 1
+
+    def write(self, fileobj):
+        sections = []
+        offset = HEADER.size
+        datas = []
+        for name in SECTIONS:
+            data = little_endian(self.tables[name]).tobytes()
+            # every section starts 8-byte aligned.
+            padding = -offset % 8
+            datas.append(bytes(padding) + data)
+            offset += padding
+            count = self.count if name == 'codeareas' else len(self.tables[name])
+            sections += [offset, count]
+            offset += len(data)
+        fileobj.write(HEADER.pack(MAGIC, OZX_VERSION, *sections))
+        for data in datas:
+            fileobj.write(data)
+
+
+def export(codeareas, fileobj):
+    writer = Writer()
+    for ca in codeareas:
+        writer.add(ca)
+    writer.write(fileobj)
+
+def export_file(fileobj, out):
+    node_table = ozpickle.load(fileobj, lazy=True)
+    export((node_table.resolve(index) for index in node_table.indexes('codearea')), out)
+
+
+class Procedure:
+    __slots__ = ('program', 'index', 'uuid', 'name', 'arity', 'xcount',
+                 'k_range', 'i_range', 'w_range')
+
+    def __init__(self, program, index):
+        (self.uuid, name, self.arity, self.xcount, k_start, k_count, i_start, i_count,
+         w_start, w_count) = CODEAREA.unpack_from(program.codeareas, index * CODEAREA.size)
+        self.program = program
+        self.index = index
+        self.name = program.string(name)
+        self.k_range = slice(k_start, k_start + k_count)
+        self.i_range = slice(i_start, i_start + i_count)
+        self.w_range = slice(w_start, w_start + w_count)
+
+    def __repr__(self):
+        return 'Procedure({}/{})'.format(self.name or '$', self.arity)
+
+    @property
+    def constants(self):
+        # (type name, text) of each constant.
+        p = self.program
+        return [(ozpickle.TYPE_IDS[t] if t < len(ozpickle.TYPE_IDS) else None, p.string(s))
+                for t, s in zip(p.ktypes[self.k_range], p.ktexts[self.k_range])]
+
+    @property
+    def pcs(self):
+        return self.program.pcs[self.i_range]
+
+    @property
+    def opcodes(self):
+        return self.program.opcodes[self.i_range]
+
+    @property
+    def words(self):
+        return self.program.words[self.w_range]
+
+    def instructions(self):
+        # (pc, opcode, operand words) of each instruction.
+        words = self.words
+        pcs = self.pcs
+        ends = list(pcs[1:]) + [len(words)]
+        for pc, opcode, end in zip(pcs, self.opcodes, ends):
+            yield (pc, opcode, words[pc+1:end])
+
+
+class Program:
+    # A loaded *.ozx file, sliced in place. Procedures are only unpacked
+    # when accessed, the name and UUID indexes on their first lookup.
+    def __init__(self, buf):
+        self.buf = buf
+        view = memoryview(buf).cast('B')
+        if len(view) < HEADER.size or view[:4] != MAGIC:
+            raise ValueError('Not an *.ozx file')
+        fields = HEADER.unpack_from(view)
+        if fields[1] != OZX_VERSION:
+            raise ValueError('Unsupported *.ozx version {}'.format(fields[1]))
+        for i, name in enumerate(SECTIONS):
+            (offset, count) = fields[2 + 2*i:4 + 2*i]
+            if name == 'codeareas':
+                (section, self.count) = (view[offset:offset + count * CODEAREA.size], count)
+            else:
+                typecode = TYPECODES[name]
+                section = view[offset:offset + count * struct.calcsize(typecode)].cast(typecode)
+                if sys.byteorder == 'big' and typecode != 'B':
+                    section = little_endian(array.array(typecode, section))
+            setattr(self, name, section)
+        self.by_name = None
+        self.by_uuid = None
+
+    def string(self, index):
+        offsets = self.string_offsets
+        return str(self.string_blob[offsets[index]:offsets[index+1]], 'utf-8', 'surrogatepass')
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return Procedure(self, index)
+
+    def __iter__(self):
+        return (Procedure(self, i) for i in range(self.count))
+
+    def build_indexes(self):
+        self.by_name = {}
+        self.by_uuid = {}
+        for i in range(self.count):
+            (uuid_bytes, name) = struct.unpack_from('<16sI', self.codeareas, i * CODEAREA.size)
+            self.by_name.setdefault(self.string(name), []).append(i)
+            self.by_uuid[uuid_bytes] = i
+
+    def lookup(self, name):
+        # the procedures with this name, or with this UUID.
+        if self.by_name is None:
+            self.build_indexes()
+        indexes = self.by_name.get(name)
+        if indexes is None:
+            try:
+                indexes = [self.by_uuid[bytes.fromhex(name.replace('-', ''))]]
+            except (ValueError, KeyError):
+                indexes = []
+        return [Procedure(self, i) for i in indexes]
+
+    def close(self):
+        for name in SECTIONS:
+            section = getattr(self, name)
+            if type(section) is memoryview:
+                section.release()
+        if hasattr(self.buf, 'close'):
+            try:
+                self.buf.close()
+            except BufferError:
+                # slices handed out still use the mapping, which is then
+                # left to the garbage collector.
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def loads(buf):
+    return Program(buf)
+
+def load(fileobj):
+    (buf, offset) = ozpickle.map_file(fileobj)
+    if buf is None or offset:
+        if buf is not None:
+            buf.close()
+        buf = fileobj.read()
+    return Program(buf)
+
+
+def print_procedure(proc):
+    print('{}/{} {}'.format(proc.name or '$', proc.arity, format_uuid(proc.uuid)))
+    for i, (type_name, text) in enumerate(proc.constants):
+        print('  K{} {} {}'.format(i, type_name, text))
+    for pc, opcode, operands in proc.instructions():
+        info = opcodes.OPCODES[opcode] if opcode < len(opcodes.OPCODES) else None
+        print('  {:4} {} {}'.format(pc, info.name if info else hex(opcode),
+                                    ' '.join(map(str, operands))))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Export *.ozf files to *.ozx and query them')
+    parser.add_argument('-o', '--output', type=argparse.FileType('wb'), metavar='FILE',
+                        help='Export the *.ozf input to this *.ozx file')
+    parser.add_argument('-l', '--list', action='store_true', help='List the procedures of an *.ozx')
+    parser.add_argument('--show', metavar='PROC',
+                        help='Print the constants and instructions of PROC (a name or UUID)')
+    parser.add_argument('input', help='An *.ozf file to export or an *.ozx file to query')
+    ns = parser.parse_args(args)
+
+    with open(ns.input, 'rb') as f:
+        if ns.output is not None:
+            export_file(f, ns.output)
+            return
+        try:
+            program = load(f)
+        except (ValueError, struct.error) as e:
+            parser.error('{}: {}'.format(ns.input, e))
+        with program:
+            if ns.list:
+                for proc in program:
+                    print('{}/{}\t{}\tinstructions={}'.format(
+                        proc.name or '$', proc.arity, format_uuid(proc.uuid), len(proc.pcs)))
+            if ns.show is not None:
+                for proc in program.lookup(ns.show):
+                    print_procedure(proc)
+
+if __name__ == '__main__':
+    main()
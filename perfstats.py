@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# Phase timings and counters of a disassembly run, see `disasm.py --stats`.
+
+import collections
+import contextlib
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PHASES = ['read', 'unpickle', 'resolve', 'decode', 'render', 'write']
+
+def max_rss():
+    # the memory high-water mark of the process in bytes, or None.
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Stats:
+    def __init__(self):
+        self.seconds = collections.OrderedDict((phase, 0.0) for phase in PHASES)
+        self.max_rss = collections.OrderedDict((phase, None) for phase in PHASES)
+        self.node_counts = collections.Counter()
+        self.files = 0
+        self.codeareas = 0
+        self.instructions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        # duplicates shared by the unpickler, by kind, and the bytes saved.
+        self.deduplicated = collections.Counter()
+        self.bytes_saved = 0
+        # codeareas shown as a reference to one with the same body (--dedupe)
+        # and their code size, None when not deduplicating.
+        self.same_body = None
+        self.same_body_bytes = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            self.max_rss[name] = max_rss()
+
+    def count_nodes(self, type_names):
+        self.node_counts.update(type_names)
+
+    def count_deduplicated(self, unpickler):
+        self.deduplicated.update(unpickler.saved)
+        self.bytes_saved += unpickler.saved_bytes
+
+    def rate(self, count, phases):
+        seconds = sum(self.seconds[phase] for phase in phases)
+        return count / seconds if seconds else 0.0
+
+    def as_dict(self):
+        return {
+            'seconds': dict(self.seconds),
+            'max_rss': dict(self.max_rss),
+            'node_counts': dict(self.node_counts),
+            'files': self.files,
+            'codeareas': self.codeareas,
+            'instructions': self.instructions,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'deduplicated': dict(self.deduplicated),
+            'bytes_saved': self.bytes_saved,
+            'same_body': self.same_body,
+            'same_body_bytes': self.same_body_bytes,
+            'instructions_per_second': self.rate(self.instructions, ['decode']),
+            'bytes_read_per_second': self.rate(self.bytes_read, ['read', 'unpickle']),
+            'bytes_written_per_second': self.rate(self.bytes_written, ['write']),
+        }
+
+    def print_report(self, file=None):
+        print('{:10} {:>10} {:>14}'.format('phase', 'seconds', 'max RSS (MB)'), file=file)
+        for phase, seconds in self.seconds.items():
+            rss = self.max_rss[phase]
+            print('{:10} {:10.3f} {:>14}'.format(
+                phase, seconds, '{:.1f}'.format(rss / 2**20) if rss is not None else '-'), file=file)
+        print('{:10} {:10.3f}'.format('total', sum(self.seconds.values())), file=file)
+        print(file=file)
+        print('files:', self.files, file=file)
+        print('nodes:', sum(self.node_counts.values()), file=file)
+        for type_name, count in sorted(self.node_counts.items(), key=lambda item: -item[1]):
+            print('  {:20} {:10}'.format(type_name, count), file=file)
+        print('codeareas:', self.codeareas, file=file)
+        print('instructions: {} ({:.0f}/s decoded)'.format(
+            self.instructions, self.rate(self.instructions, ['decode'])), file=file)
+        print('read: {} bytes ({:.0f} bytes/s)'.format(
+            self.bytes_read, self.rate(self.bytes_read, ['read', 'unpickle'])), file=file)
+        print('written: {} bytes ({:.0f} bytes/s)'.format(
+            self.bytes_written, self.rate(self.bytes_written, ['write'])), file=file)
+        print('deduplicated: {} ({} bytes saved)'.format(
+            ', '.join('{} {}'.format(count, kind) for kind, count in sorted(self.deduplicated.items()))
+            or 'nothing', self.bytes_saved), file=file)
+        if self.same_body is not None:
+            ratio = self.same_body / self.codeareas if self.codeareas else 0.0
+            print('same body: {} of {} codeareas ({:.1%}), {} code bytes not decoded'.format(
+                self.same_body, self.codeareas, ratio, self.same_body_bytes), file=file)
+
+
+def timed(stats, name):
+    # stats.phase(name), or nothing without stats.
+    return stats.phase(name) if stats is not None else contextlib.nullcontext()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Regression tests, run with `python -m unittest tests` (or pytest).
+
+import contextlib
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import codecache
+import disasm
+import opstats
+import ozpickle
+import ozx
+from oznodes import UNIT, CodeArea, Abstraction, Record
+
+def make_code(*words):
+    return struct.pack('>{}H'.format(len(words)), *words)
+
+def make_abstraction_file():
+    # Outer creates an abstraction of Inner (createAbstractionStoreX).
+    inner = CodeArea(bytes(16), make_code(0x40), 0, 1, 'Inner', UNIT, [])
+    outer = CodeArea((1).to_bytes(16, 'big'), make_code(0x60, 0, 1, 0, 0, 1, 0x40),
+                     2, 2, 'Outer', UNIT, [inner])
+    return ozpickle.dumps(Record('export', [('outer', Abstraction((2).to_bytes(16, 'big'),
+                                                                    outer, []))]))
+
+def run_disasm(args):
+    # (status, stdout, stderr) of disasm.py.
+    (out, err) = (io.StringIO(), io.StringIO())
+    status = 0
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            disasm.main(args)
+        except SystemExit as e:
+            status = e.code
+    return (status, out.getvalue(), err.getvalue())
+
+
+class DisasmTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_stream_create_abstraction(self):
+        path = self.write('abstraction.ozf', make_abstraction_file())
+        (status, out, err) = run_disasm(['--stream', path])
+        self.assertEqual((status, err), (0, ''))
+        self.assertRegex(out, r'X0 <- <Node \d+>')
+        (status, out, err) = run_disasm([path])
+        self.assertIn('X0 <- Inner', out)
+
+    def test_batch_skips_garbage(self):
+        # the node count of the header is not trusted before allocating.
+        self.write('a.ozf', b'garbage')
+        self.write('b.ozf', make_abstraction_file())
+        out_dir = os.path.join(self.dir, 'out')
+        (status, out, err) = run_disasm(['-O', out_dir, self.dir])
+        self.assertEqual(status, 1)
+        self.assertIn('a.ozf: Corrupt header', err)
+        self.assertEqual(os.listdir(out_dir), ['b.asm'])
+
+    def test_ozx_rejects_other_files(self):
+        ozf = self.write('abstraction.ozf', make_abstraction_file())
+        ozx_path = os.path.join(self.dir, 'abstraction.ozx')
+        ozx.main(['-o', ozx_path, ozf])
+        for path in (ozf, self.write('short.ozx', b'OZX')):
+            err = io.StringIO()
+            with contextlib.redirect_stderr(err), self.assertRaises(SystemExit):
+                ozx.main(['--list', path])
+            self.assertIn('Not an *.ozx file', err.getvalue())
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            ozx.main(['--list', ozx_path])
+        self.assertIn('Outer/2', out.getvalue())
+
+    def test_pc_prefixes_bounded(self):
+        self.assertEqual(disasm.pc_prefix(disasm.MAX_CACHED_PC + 10**6).strip(),
+                         '/* {} */'.format(disasm.MAX_CACHED_PC + 10**6))
+        self.assertEqual(disasm.pc_prefix(disasm.MAX_CACHED_PC - 1).strip(),
+                         '/* {} */'.format(disasm.MAX_CACHED_PC - 1))
+        self.assertLessEqual(len(disasm._PC_PREFIXES), disasm.MAX_CACHED_PC)
+
+
+class MemoryCacheTest(unittest.TestCase):
+    def test_replace_keeps_size(self):
+        cache = codecache.MemoryCache(max_size=20)
+        cache.remember('a', 'x' * 6)
+        cache.remember('b', 'y' * 4)
+        cache.remember('a', 'z' * 6)
+        self.assertEqual(cache.size, 10)
+        self.assertEqual(cache.get('b'), 'y' * 4)
+
+
+class OpcodeStatsTest(unittest.TestCase):
+    def users(self, numpy):
+        # moveXX, then an unknown opcode.
+        codeareas = [CodeArea(bytes(16), make_code(0x01, 0, 1, 0x1234), 0, 2, 'Unknown', UNIT, []),
+                     CodeArea(bytes(16), make_code(0x01, 0, 1, 0x40), 0, 2, 'Known', UNIT, [])]
+        saved = opstats.numpy
+        opstats.numpy = numpy
+        try:
+            stats = opstats.OpcodeStats(codeareas)
+            return {op: [ca.name for ca in stats.users(op)] for op in (0x01, 0x1234, 0x1300)}
+        finally:
+            opstats.numpy = saved
+
+    def test_users_above_0xff(self):
+        expected = {0x01: ['Unknown', 'Known'], 0x1234: ['Unknown'], 0x1300: ['Unknown']}
+        self.assertEqual(self.users(None), expected)
+        if opstats.numpy is not None:
+            self.assertEqual(self.users(opstats.numpy), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
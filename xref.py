@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# Cross-reference index of the procedures of an *.ozf file: who calls whom,
+# which builtins each procedure uses and where each constant is referenced.
+# Procedures are identified by their UUID, builtins by 'Module.name' and
+# other constants by their ozify() rendering, or a digest of the large ones.
+
+import argparse
+import collections
+import hashlib
+import json
+import codecache
+import ozpickle
+import oznodes
+import opcodes
+from ozify import ozify
+
+XREF_VERSION = 1
+
+# constants whose flattened form (see codecache) is longer are keyed by a
+# digest of it: ozify() is recursive and its output unbounded.
+MAX_RENDERED = 1024
+
+def constant_key(k, memo=None):
+    # `memo` maps the id of the constants already keyed to their key, as
+    # large ones are often shared by many codeareas.
+    t = type(k)
+    if t is oznodes.Abstraction:
+        k = k.codearea
+        t = type(k)
+    if t is oznodes.CodeArea:
+        return oznodes.format_uuid(k.uuid)
+    elif t is oznodes.Builtin:
+        return '{}.{}'.format(k.module, k.name)
+    elif not isinstance(k, oznodes.Node) or not k.ref_fields:
+        return str(ozify(k))
+    key = memo.get(id(k)) if memo is not None else None
+    if key is None:
+        flat = codecache.flatten_constants(k)
+        if len(flat) <= MAX_RENDERED:
+            key = str(ozify(k))
+        else:
+            digest = hashlib.sha1(flat.encode('utf-8', 'surrogatepass')).hexdigest()
+            key = '<{} {}>'.format(ozpickle.type_name(k), digest[:16])
+        if memo is not None:
+            memo[id(k)] = key
+    return key
+
+
+class CrossReference:
+    def __init__(self):
+        self.procedures = {}
+        self.by_name = collections.defaultdict(list)
+        self.callees = collections.defaultdict(list)
+        self.callers = collections.defaultdict(list)
+        self.builtins = collections.defaultdict(list)
+        self.references = collections.defaultdict(list)
+        self.keys = {}
+
+    @classmethod
+    def build(cls, codeareas):
+        xref = cls()
+        for ca in codeareas:
+            xref.add(ca)
+        return xref
+
+    def add(self, ca):
+        proc = oznodes.format_uuid(ca.uuid)
+        if proc in self.procedures:
+            return
+        self.procedures[proc] = {'name': ca.name, 'arity': ca.arity}
+        self.by_name[ca.name].append(proc)
+
+        for k in set(constant_key(k, self.keys) for k in ca.ks):
+            self.references[k].append(proc)
+
+        stream = opcodes.InstructionStream(ca.code, ca.ks)
+        callees = set()
+        for pc, callee in stream.call_sites():
+            if type(callee) is oznodes.Reg:
+                # only known at run time.
+                continue
+            key = constant_key(callee, self.keys)
+            if key in callees:
+                continue
+            callees.add(key)
+            self.callees[proc].append(key)
+            self.callers[key].append(proc)
+            if type(callee) is oznodes.Builtin:
+                self.builtins[proc].append(key)
+
+    def lookup(self, name):
+        # the UUIDs of the procedures with this name, or with this UUID.
+        if name in self.procedures:
+            return [name]
+        return self.by_name.get(name, [])
+
+    def describe(self, key):
+        proc = self.procedures.get(key)
+        return '{}/{}'.format(proc['name'] or '$', proc['arity']) if proc else key
+
+    def who_calls(self, name):
+        return [caller for key in self.lookup(name) or [name] for caller in self.callers.get(key, ())]
+
+    def calls_of(self, name):
+        return [callee for proc in self.lookup(name) for callee in self.callees.get(proc, ())]
+
+    def builtins_of(self, name):
+        return [builtin for proc in self.lookup(name) for builtin in self.builtins.get(proc, ())]
+
+    def referencing(self, key):
+        return self.references.get(key, [])
+
+    def to_json(self):
+        return {
+            'version': XREF_VERSION,
+            'procedures': self.procedures,
+            'callees': self.callees,
+            'builtins': self.builtins,
+            'references': self.references,
+        }
+
+    @classmethod
+    def from_json(cls, obj):
+        if obj.get('version') != XREF_VERSION:
+            raise ValueError('Unsupported cross-reference index version {}'.format(obj.get('version')))
+        xref = cls()
+        xref.procedures = obj['procedures']
+        for proc, info in xref.procedures.items():
+            xref.by_name[info['name']].append(proc)
+        xref.callees.update(obj['callees'])
+        for proc, callees in xref.callees.items():
+            for callee in callees:
+                xref.callers[callee].append(proc)
+        xref.builtins.update(obj['builtins'])
+        xref.references.update(obj['references'])
+        return xref
+
+    def save(self, fileobj):
+        json.dump(self.to_json(), fileobj)
+
+    @classmethod
+    def load(cls, fileobj):
+        return cls.from_json(json.load(fileobj))
+
+
+def build_from_file(fileobj):
+    node_table = ozpickle.load(fileobj, lazy=True)
+    return CrossReference.build(node_table.resolve(index)
+                                for index in node_table.indexes('codearea'))
+
+def load_any(path):
+    # a saved index (JSON) or an *.ozf file.
+    with open(path, 'rb') as f:
+        if f.peek(1)[:1] == b'{':
+            return CrossReference.from_json(json.loads(f.read().decode('utf-8')))
+        return build_from_file(f)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Query the cross-references of *.ozf files')
+    parser.add_argument('-s', '--save', type=argparse.FileType('w'), metavar='FILE',
+                        help='Save the index as JSON, to be reloaded instead of the *.ozf')
+    parser.add_argument('--callers', metavar='PROC',
+                        help='Procedures calling PROC (a name, UUID or Module.builtin)')
+    parser.add_argument('--callees', metavar='PROC', help='Procedures and builtins called by PROC')
+    parser.add_argument('--builtins', metavar='PROC', help='Builtins called by PROC')
+    parser.add_argument('--refs', metavar='CONSTANT',
+                        help='Procedures referencing CONSTANT in their constants table')
+    parser.add_argument('input', help='An *.ozf file or a saved index')
+    ns = parser.parse_args(args)
+
+    xref = load_any(ns.input)
+    if ns.save is not None:
+        xref.save(ns.save)
+    for query, answer in [(ns.callers, xref.who_calls), (ns.callees, xref.calls_of),
+                          (ns.builtins, xref.builtins_of), (ns.refs, xref.referencing)]:
+        if query is not None:
+            for key in answer(query):
+                print(xref.describe(key))
+
+if __name__ == '__main__':
+    main()